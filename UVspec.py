@@ -1,10 +1,154 @@
 import os
+import sys
+import csv
+import json
+import time
+import hashlib
+import threading
 import scipy
 import numpy as np
 from scipy.optimize import leastsq
+import UVspecParse
 home = os.environ['HOME']
 from subprocess import Popen,PIPE, STDOUT, call
 
+# Resources used by the uvspec children : one record per run, with the
+# return code, wall and cpu times, peak memory and the simulated parameters.
+# RUN_LOG_SINK is an optional .csv or .jsonl file where the records are appended.
+# The records of other processes (e.g. a process pool) are added with merge_run_log,
+# the sink is then only written by the process merging them.
+RUN_LOG = []
+RUN_LOG_SINK = os.getenv('UVSPEC_RUNLOG')
+RUN_LOG_FIELDS = ['date','returncode','walltime','utime','stime','maxrss_kb',
+                  'airmass','pwv','ozone','aerosols','pressure',
+                  'rte_solver','mol_abs_param','wavelength','input_hash']
+_run_log_lock = threading.Lock()
+
+class UVspecError(RuntimeError):
+    """ uvspec failed : nonzero exit status, killed after its timeout or invalid output """
+    pass
+
+class UVspecOutputError(UVspecError):
+    """ uvspec ran but its output is rejected : truncated, out of range, inconsistent sampling """
+    pass
+
+def run_log():
+    """ Returns a copy of the records of the uvspec runs of this process """
+    with _run_log_lock:
+        return [dict(record) for record in RUN_LOG]
+
+def clear_run_log():
+    """ Forgets the records of the uvspec runs, the sink file is kept """
+    with _run_log_lock:
+        del RUN_LOG[:]
+
+def set_run_log_sink(filename):
+    """ Appends the next records to filename, as csv if it ends with .csv,
+        as json lines otherwise. None stops writing them.
+    """
+    global RUN_LOG_SINK
+    RUN_LOG_SINK = filename
+
+def record_run(uvspec, returncode, walltime, rusage=None):
+    """ Stores the record of one uvspec run in RUN_LOG and in RUN_LOG_SINK.
+
+        rusage is the resource usage of the child as returned by os.wait4,
+        None when it is not available : cpu times and memory are then None.
+    """
+    record = dict((field,None) for field in RUN_LOG_FIELDS)
+    record['date'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    record['returncode'] = returncode
+    record['walltime'] = walltime
+    if rusage is not None:
+        record['utime'] = rusage.ru_utime
+        record['stime'] = rusage.ru_stime
+        # ru_maxrss is in kilobytes on linux and in bytes on macOS
+        if sys.platform == 'darwin':
+            record['maxrss_kb'] = rusage.ru_maxrss/1024.
+        else:
+            record['maxrss_kb'] = rusage.ru_maxrss
+    for key in ['rte_solver','mol_abs_param','wavelength']:
+        if key in uvspec.inp:
+            record[key] = uvspec.inp[key]
+    record.update(uvspec.tags)
+    record['input_hash'] = uvspec.input_hash()
+    merge_run_log([record])
+    return record
+
+def merge_run_log(records):
+    """ Adds records of uvspec runs, e.g. returned by the workers of a process pool,
+        to RUN_LOG and RUN_LOG_SINK
+    """
+    with _run_log_lock:
+        for record in records:
+            RUN_LOG.append(record)
+            if RUN_LOG_SINK:
+                _write_record(RUN_LOG_SINK, record)
+
+class _Lines(list):
+    # file-like list of the lines written by csv
+    write = list.append
+
+def _write_record(filename, record):
+    # one write in append mode : the records of concurrent processes are not mixed
+    fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        if filename.endswith('.csv'):
+            lines = _Lines()
+            writer = csv.DictWriter(lines, RUN_LOG_FIELDS, extrasaction='ignore', lineterminator='\n')
+            if os.fstat(fd).st_size == 0:
+                writer.writeheader()
+            writer.writerow(record)
+            text = ''.join(lines)
+        else:
+            text = json.dumps(record, sort_keys=True)+'\n'
+        os.write(fd, text.encode('utf-8'))
+    finally:
+        os.close(fd)
+
+def wait_child(p):
+    """ Waits for the Popen p and returns the resource usage of the child,
+        from os.wait4 where available (None otherwise). p.returncode is set.
+    """
+    if not hasattr(os, 'wait4'):
+        p.wait()
+        return None
+    pid, status, rusage = os.wait4(p.pid, 0)
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+def start_timeout(p, timeout):
+    """ Kills the Popen p if it is still running after timeout seconds.
+
+        Returns the started timer, None if timeout is None. timer.expired
+        tells whether the child was killed.
+    """
+    if timeout is None:
+        return None
+    def kill():
+        timer.expired = True
+        try:
+            p.kill()
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.expired = False
+    timer.daemon = True
+    timer.start()
+    return timer
+
+def check_child(p, timer, cmd):
+    """ Raises UVspecError if the child was killed by its timer or exited with an error """
+    if timer is not None:
+        timer.cancel()
+        if timer.expired and p.returncode != 0:
+            raise UVspecError('%s killed after %g s' % (cmd, timer.interval))
+    if p.returncode != 0:
+        raise UVspecError('%s exited with status %d' % (cmd, p.returncode))
+
 class UVspec:
     def __init__(self,home=''):
         if home=='':
@@ -12,37 +156,105 @@ class UVspec:
         else:
             self.home=home
         self.inp = { }
+        # simulated parameters (airmass, pwv, ...) stored with the run records
+        self.tags = { }
 
         
-    def write_input(self, fn):
-        f = open(fn,'w')
+    def input_string(self):
+        """ Returns the uvspec input, as written in the input file, in a string """
+        lines = []
         for key in sorted(self.inp):
             if key=="mol_modify2":
-                f.write( "mol_modify" + ' ' + str(self.inp[key]) + '\n')
+                lines.append( "mol_modify" + ' ' + str(self.inp[key]) + '\n')
             else:
-                f.write( key + ' ' + str(self.inp[key]) + '\n')
-            
+                lines.append( key + ' ' + str(self.inp[key]) + '\n')
+        return ''.join(lines)
+
+    def input_hash(self, version=''):
+        """ Returns a sha1 hex digest of the input options and of version.
+
+            The options are hashed in the order they are written to the input
+            file, two UVspec with the same options thus have the same hash.
+        """
+        h = hashlib.sha1()
+        h.update(version.encode('ascii'))
+        h.update(b'\n')
+        h.update(self.input_string().encode('ascii'))
+        return h.hexdigest()
+
+    def write_input(self, fn):
+        f = open(fn,'w')
+        f.write(self.input_string())
         f.close()
 
+    def command(self,path=''):
+        """ Returns the path to the uvspec executable """
+        if path != '':
+            return path+'bin/uvspec'
+        else:
+            return self.home+'/libRadtran/bin/uvspec'
+
     def worker(self,num,input,output):
         """thread worker function"""
         verbose = 0
         self.run(input,output,verbose)
         return
             
-    def run(self,inp, out, verbose,path=''):
+    def run(self,inp, out, verbose,path='',timeout=None):
+        """ Runs uvspec on the input file inp, the output is written in out.
+
+            timeout is the maximum run time in seconds, the child is then killed.
+            Raises UVspecError if uvspec fails or is killed.
+        """
+        cmd = self.command(path)
         if verbose:
             print("Running uvspec with input file: ", inp)
             print("Output to file                : ", out)
-        if path != '':
-            cmd = path+'bin/uvspec '+  ' < ' + inp  +  ' > ' + out
-        else:
-            cmd = self.home+'/libRadtran/bin/uvspec '+  ' < ' + inp  +  ' > ' + out
+            print("uvspec cmd: ", cmd+' < '+inp+' > '+out)
+        # no shell : the input and output files are connected to the process
+        fin = open(inp,'r')
+        fout = open(out,'w')
+        try:
+            start = time.time()
+            p   = Popen([cmd],stdin=fin,stdout=fout)
+            timer = start_timeout(p, timeout)
+            rusage = wait_child(p)
+            record_run(self, p.returncode, time.time()-start, rusage)
+        finally:
+            fin.close()
+            fout.close()
+        check_child(p, timer, cmd)
+
+    def run_inmemory(self, verbose, path='', timeout=None):
+        """ Runs uvspec with the input streamed on stdin and parses stdout.
+
+            No input or output file is written. timeout is the maximum run
+            time in seconds. Raises UVspecError if uvspec fails or is killed.
+
+            Output:
+               data   array of the output_user columns, one row per wavelength
+        """
+        cmd = self.command(path)
         if verbose:
-            print("uvspec cmd: ", cmd)
-#        p   = call(cmd,shell=True,stdin=PIPE,stdout=PIPE)
-        p   = Popen(cmd,shell=True,stdout=PIPE)
-        p.wait()
+            print("Running uvspec in memory, cmd: ", cmd)
+        start = time.time()
+        p   = Popen([cmd],stdin=PIPE,stdout=PIPE)
+        timer = start_timeout(p, timeout)
+        # the input is much smaller than the pipe buffer, and uvspec reads
+        # all of it before writing : no deadlock without communicate, which
+        # would reap the child before wait4 gets its resource usage
+        try:
+            p.stdin.write(self.input_string().encode('ascii'))
+            p.stdin.close()
+        except (IOError, OSError):
+            # uvspec exited before reading its input, reported by check_child
+            pass
+        out = p.stdout.read()
+        p.stdout.close()
+        rusage = wait_child(p)
+        record_run(self, p.returncode, time.time()-start, rusage)
+        check_child(p, timer, cmd)
+        return UVspecParse.parse_columns(out)
 
 def peval(x, p):
     return p[0] + p[1]*x + p[2]*x*x  + p[3]*x**3  # + p[4]*x**4 +p[5]*x**5 +p[6]*x**6 +p[7]*x**7 
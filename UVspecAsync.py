@@ -0,0 +1,150 @@
+"""
+UVspecAsync
+===========
+
+asyncio front end of UVspec (python 3 only).
+
+Many uvspec children are run concurrently from one process, while the
+event loop stays free for other work (FITS I/O, MERRA2 lookups, ...).
+At most maxconcurrency children run at the same time.
+
+Usage, in a notebook where an event loop is already running:
+
+    import libsimulateTranspCTIOScattAbsAer as atmsim
+    from UVspecAsync import AsyncUVspecRunner
+
+    runner = AsyncUVspecRunner(maxconcurrency=8, path=atmsim.libradtranpath,
+                               timeout=atmsim.UVSPEC_TIMEOUT, retries=atmsim.UVSPEC_RETRIES,
+                               check=atmsim.CheckAsyncSimulation)
+    uvspecs = [atmsim.ConfigureSimulationaer(1.2, pwv, 300., 0.05, 780.)[0] for pwv in [0., 2., 4.]]
+    results = await runner.gather(uvspecs)      # list of (wl, edir)
+
+and from a script:
+
+    results = runner.run_all(uvspecs)
+
+As atmsim.RunSimulation, a run is killed after timeout seconds, and a failed
+run or an output rejected by check is tried again retries times before
+UVspec.UVspecError is raised.
+
+"""
+
+import asyncio
+import os
+import time
+
+import UVspec
+import UVspecParse
+
+
+class AsyncUVspecRunner:
+    """
+    AsyncUVspecRunner(maxconcurrency,path) :
+        run uvspec with asyncio.create_subprocess_exec, the input is streamed
+        on stdin and stdout is parsed in memory as in UVspec.run_inmemory
+    Args:
+        maxconcurrency (:obj:`int`): maximum number of uvspec running at the same time,
+            default is the number of cpus
+        path (:obj:`str`): libradtran installation directory, as the path argument of UVspec.run
+        timeout (:obj:`float`): seconds after which a uvspec run is killed, None for no limit
+        retries (:obj:`int`): number of times a failed run is tried again
+        check (:obj:`callable`): check(uvspec,data) validates the output columns of a run,
+            raising ValueError to reject it
+    """
+
+    def __init__(self, maxconcurrency=None, path='', timeout=None, retries=0, check=None):
+        if maxconcurrency is None:
+            maxconcurrency = os.cpu_count() or 1
+        if maxconcurrency < 1:
+            raise ValueError('maxconcurrency must be at least 1, got %d' % maxconcurrency)
+        self.maxconcurrency = maxconcurrency
+        self.path = path
+        self.timeout = timeout
+        self.retries = retries
+        self.check = check
+        self._semaphore = None
+        self._loop = None
+
+    def _get_semaphore(self):
+        # the semaphore belongs to the running event loop, it is created again
+        # when the runner is used from another loop (e.g. successive asyncio.run)
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.maxconcurrency)
+            self._loop = loop
+        return self._semaphore
+
+    async def run(self, uvspec, verbose=False):
+        """
+        run(uvspec,verbose) : coroutine running uvspec for the options of the UVspec object
+        Returns:
+            array of the output_user columns, one row per wavelength
+        """
+        cmd = uvspec.command(self.path)
+        async with self._get_semaphore():
+            if verbose:
+                print("Running uvspec asynchronously, cmd: ", cmd)
+            start = time.time()
+            proc = await asyncio.create_subprocess_exec(cmd, stdin=asyncio.subprocess.PIPE,
+                                                        stdout=asyncio.subprocess.PIPE)
+            try:
+                out, err = await asyncio.wait_for(proc.communicate(uvspec.input_string().encode('ascii')),
+                                                  self.timeout)
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                UVspec.record_run(uvspec, proc.returncode, time.time()-start)
+                raise UVspec.UVspecError('uvspec killed after %g s' % self.timeout)
+            # the child is reaped by the event loop : no resource usage
+            UVspec.record_run(uvspec, proc.returncode, time.time()-start)
+        if proc.returncode != 0:
+            raise UVspec.UVspecError('uvspec exited with status %d' % proc.returncode)
+        data = UVspecParse.parse_columns(out)
+        if self.check is not None:
+            self.check(uvspec, data)
+        return data
+
+    async def run_checked(self, uvspec):
+        """
+        run_checked(uvspec) : coroutine running uvspec up to retries+1 times,
+            until a run succeeds and its output passes check
+        Returns:
+            array of the output_user columns, one row per wavelength
+        """
+        for attempt in range(self.retries+1):
+            try:
+                return await self.run(uvspec)
+            except (UVspec.UVspecError, ValueError) as error:
+                print('uvspec run %d/%d failed : %s' % (attempt+1, self.retries+1, error))
+                lasterror = error
+        raise UVspec.UVspecError('uvspec failed %d times, last error : %s' % (self.retries+1, lasterror))
+
+    async def transmission(self, uvspec):
+        """
+        transmission(uvspec) : coroutine returning the arrays (wl,edir) of an
+            output_user 'lambda edir' simulation
+        """
+        data = await self.run_checked(uvspec)
+        return data[:, 0], data[:, 1]
+
+    def submit(self, uvspec):
+        """
+        submit(uvspec) : schedule the simulation in the running loop
+        Returns:
+            an asyncio.Task, awaiting it gives (wl,edir)
+        """
+        return asyncio.ensure_future(self.transmission(uvspec))
+
+    async def gather(self, uvspecs):
+        """
+        gather(uvspecs) : coroutine running all the simulations
+        Returns:
+            list of (wl,edir), in the order of uvspecs
+        """
+        return await asyncio.gather(*[self.transmission(uvspec) for uvspec in uvspecs])
+
+    def run_all(self, uvspecs):
+        """
+        run_all(uvspecs) : blocking version of gather, for scripts without a running loop
+        """
+        return asyncio.run(self.gather(uvspecs))
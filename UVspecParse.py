@@ -0,0 +1,170 @@
+"""
+UVspecParse
+===========
+
+Vectorized parsers of the uvspec text outputs.
+
+The whole output is converted by numpy in one call from the bytes of a file
+or of a pipe, instead of the line by line loops of UVspec.read_rad_spc and of
+np.loadtxt before numpy 1.23 (np.fromstring there, the C parser of np.loadtxt
+since, see benchmarks/bench_parse.py):
+
+    data = parse_columns(out)                  # output_user, any number of columns
+    wl, edir = parse_lambda_edir(out)          # output_user lambda edir
+    data = read_columns('result.OUT')          # same from a file
+    RAD, STD = parse_rad_spc(out, nx, ny)      # mystic radiance spectra (rad_spc)
+
+The values are copied into preallocated arrays given with the out argument
+(they are parsed into a temporary array first). A truncated, ragged or
+corrupted output raises ValueError.
+
+"""
+
+import warnings
+
+import numpy as np
+
+# np.loadtxt is implemented in C from numpy 1.23, in python before
+FAST_LOADTXT = np.lib.NumpyVersion(np.__version__) >= '1.23.0'
+
+
+def read_bytes(f):
+    """ Returns the content of f : a file name, or an open binary file or pipe """
+    if hasattr(f, 'read'):
+        return f.read()
+    fin = open(f, 'rb')
+    try:
+        return fin.read()
+    finally:
+        fin.close()
+
+
+def parse_columns(buf, ncols=None, out=None):
+    """ Parses the whitespace separated columns of a uvspec output.
+
+        Input:
+           buf    bytes (or str) of the output, or an open binary file or pipe
+           ncols  expected number of columns, default is the number of columns of the first line
+           out    optional preallocated float array of shape (nrows,ncols), the parsed values
+                  are copied into it and it is returned
+
+        Output:
+           data   float array, one row per line of the output
+    """
+    if hasattr(buf, 'read'):
+        buf = buf.read()
+    if isinstance(buf, bytes):
+        newline = b'\n'
+    else:
+        newline = '\n'
+    if len(buf.strip()) == 0:
+        raise ValueError('empty uvspec output')
+    if not buf.endswith(newline):
+        # uvspec ends all its lines, the last one was cut
+        raise ValueError('truncated uvspec output, no end of line after %r' % buf[-20:])
+    buf = buf.strip()
+    if FAST_LOADTXT:
+        # also raises ValueError on a ragged or corrupted table
+        data = np.loadtxt(buf.splitlines(), dtype=float, ndmin=2)
+        if ncols is not None and data.shape[1] != ncols:
+            raise ValueError('uvspec output has %d columns, %d expected' % (data.shape[1], ncols))
+    else:
+        data = parse_fromstring(buf, ncols)
+    if out is not None:
+        if out.shape != data.shape:
+            raise ValueError('output array of shape %s for uvspec output of shape %s' % (str(out.shape), str(data.shape)))
+        out[...] = data
+        return out
+    return data
+
+
+def parse_fromstring(buf, ncols=None):
+    """ Parses the stripped output buf with np.fromstring, see parse_columns """
+    newline = b'\n' if isinstance(buf, bytes) else '\n'
+    nrows = buf.count(newline) + 1
+    if ncols is None:
+        ncols = len(buf[:buf.find(newline)].split()) if nrows > 1 else len(buf.split())
+    with warnings.catch_warnings():
+        # older numpy only warn when the text can not be parsed to its end
+        warnings.simplefilter('error', DeprecationWarning)
+        try:
+            values = np.fromstring(buf, dtype=float, sep=' ')
+        except DeprecationWarning as error:
+            raise ValueError(str(error))
+    if values.size != nrows*ncols:
+        raise ValueError('uvspec output of %d lines has %d values, %d columns expected' % (nrows, values.size, ncols))
+    check_columns(buf, nrows, ncols)
+    return values.reshape(nrows, ncols)
+
+
+def check_columns(buf, nrows, ncols):
+    """ Checks that each of the nrows lines of buf (stripped) has ncols values,
+        a ragged table with the right total number of values raises ValueError """
+    if not isinstance(buf, bytes):
+        buf = buf.encode('ascii')
+    chars = np.frombuffer(buf, dtype=np.uint8)
+    # spaces, tabs, end of lines and the other control characters
+    space = chars <= 32
+    # a value starts after a space, the first one at the start of buf
+    starts = np.flatnonzero(space[:-1] > space[1:]) + 1
+    newlines = np.flatnonzero(chars == 10)
+    counts = np.bincount(np.searchsorted(newlines, starts), minlength=nrows)
+    counts[0] += 1
+    if np.any(counts != ncols):
+        line = np.flatnonzero(counts != ncols)[0]
+        raise ValueError('line %d of the uvspec output has %d values, %d expected' % (line+1, counts[line], ncols))
+
+
+def read_columns(fn, ncols=None, out=None):
+    """ Reads the uvspec output file fn, see parse_columns """
+    return parse_columns(read_bytes(fn), ncols, out)
+
+
+def parse_lambda_edir(buf, out=None):
+    """ Parses an output_user 'lambda edir' output.
+
+        Output:
+           wl     wavelengths in nm
+           edir   direct beam
+        the two columns of out (shape (nrows,2)) when it is given
+    """
+    data = parse_columns(buf, 2, out)
+    return data[:, 0], data[:, 1]
+
+
+def read_rad_spc(fn, nx, ny, nrgb=1, out=None):
+    """ Reads the mystic radiance spectrum file fn, see parse_rad_spc """
+    return parse_rad_spc(read_bytes(fn), nx, ny, nrgb, out)
+
+
+def parse_rad_spc(buf, nx, ny, nrgb=1, out=None):
+    """ Parses a mystic radiance spectrum output (rad_spc), as UVspec.read_rad_spc.
+
+        The lines are 'lambda ix iy iz rad [std]', the nrgb channels follow
+        each other in blocks of nx*ny lines.
+
+        Input:
+           out    optional preallocated (RAD,STD) arrays of shape (ny,nx,nrgb)
+
+        Output:
+           RAD    radiance, shape (ny,nx,nrgb)
+           STD    standard deviation, 0 when the output has no std column
+    """
+    data = parse_columns(buf)
+    if data.shape[1] < 5:
+        raise ValueError('rad_spc output has %d columns, at least 5 expected' % data.shape[1])
+    if data.shape[0] != nx*ny*nrgb:
+        raise ValueError('rad_spc output has %d lines, %d expected' % (data.shape[0], nx*ny*nrgb))
+    if out is None:
+        RAD = np.zeros((ny, nx, nrgb))
+        STD = np.zeros((ny, nx, nrgb))
+    else:
+        RAD, STD = out
+        STD[...] = 0.
+    ix = data[:, 1].astype(int)
+    iy = data[:, 2].astype(int)
+    ir = np.arange(data.shape[0])//(nx*ny)
+    RAD[iy, ix, ir] = data[:, 4]
+    if data.shape[1] > 5:
+        STD[iy, ix, ir] = data[:, 5]
+    return RAD, STD
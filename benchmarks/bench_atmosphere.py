@@ -0,0 +1,48 @@
+"""
+Benchmarks of the atmospheric grid : simulation and FITS and HDF5 I/O
+"""
+
+import os
+
+import pytest
+
+import spectractorsim as sim
+import libsimulateTranspCTIOScattAbsAer as atmsim
+
+
+def test_atmospheregrid_compute(benchmark, grid_size):
+    atm = sim.AtmosphereGrid(1.2, 782.5, 10., 'reduc_20170530_060_spectrum.fits')
+    atmgrid = benchmark.pedantic(atm.compute, rounds=3, iterations=1)
+    assert atmgrid.shape[0] == grid_size+1
+    atmsim.CleanSimDir()
+
+
+def test_atmospheregrid_savefile(benchmark, atmgrid, tmp_path):
+    filename = str(tmp_path/'atmsim.fits')
+    benchmark(atmgrid.savefile, filename=filename)
+    assert os.path.isfile(filename)
+
+
+def test_atmospheregrid_loadfile(benchmark, atmgrid, tmp_path):
+    filename = str(tmp_path/'atmsim.fits')
+    atmgrid.savefile(filename=filename)
+    atm = sim.AtmosphereGrid(1.2, 782.5, 10., '')
+    grid, header = benchmark(atm.loadfile, filename)
+    assert grid.shape == atmgrid.atmgrid.shape
+
+
+def test_atmospheregrid_savefile_hdf5(benchmark, atmgrid, tmp_path):
+    pytest.importorskip('h5py')
+    filename = str(tmp_path/'atmsim.h5')
+    benchmark(atmgrid.savefile, filename=filename)
+    assert os.path.isfile(filename)
+
+
+def test_atmospheregrid_loadfile_hdf5_partial(benchmark, atmgrid, tmp_path):
+    pytest.importorskip('h5py')
+    filename = str(tmp_path/'atmsim.h5')
+    atmgrid.savefile(filename=filename)
+    atm = sim.AtmosphereGrid(1.2, 782.5, 10., '')
+    pwvmax = sim.PWV_Points[-1]
+    grid, header = benchmark(atm.loadfile, filename, pwv=(pwvmax, pwvmax))
+    assert grid.shape[0]-1 == sim.NB_ATM_POINTS//sim.NB_PWV_POINTS
@@ -0,0 +1,35 @@
+"""
+Benchmark of the MERRA2 atmospheric parameters over a night of CTIO exposures
+"""
+
+import os
+
+import pandas as pd
+import pytest
+
+import libMerra2
+
+MERRA2DIR = os.path.dirname(os.path.abspath(libMerra2.__file__))
+
+
+@pytest.fixture(scope='module')
+def df_merra2():
+    df = pd.read_csv(os.path.join(MERRA2DIR, 'MERRA2_2017_M2I1NXASM_M2T1NXAER_M2T1NXRAD_ctio_AllYear.csv'), index_col=0)
+    df.index.name = 'time'
+    return df
+
+
+@pytest.fixture(scope='module')
+def night_timestamps():
+    """ the timestamps of all the exposures of the night of May 30th 2017 """
+    logbook = pd.read_csv(os.path.join(MERRA2DIR, 'ctiofulllogbook_jun2017_v4.csv'), sep=';', encoding='latin-1')
+    return pd.to_datetime(logbook[logbook['subdir'] == 'data_30may17']['date'].values)
+
+
+def get_night_parameters(timestamps, df_merra2):
+    return [libMerra2.GetAtmosphericParameters(timestamp, df_merra2) for timestamp in timestamps]
+
+
+def test_getatmosphericparameters_night(benchmark, night_timestamps, df_merra2):
+    results = benchmark.pedantic(get_night_parameters, args=(night_timestamps, df_merra2), rounds=3, iterations=1)
+    assert len(results) == len(night_timestamps)
@@ -0,0 +1,35 @@
+"""
+Benchmarks of the parsers of the uvspec outputs against np.loadtxt
+
+parse_columns uses the C parser of np.loadtxt from numpy 1.23 and np.fromstring
+(parse_fromstring) before : the gain over np.loadtxt is with the older numpy.
+"""
+
+import io
+
+import numpy as np
+import pytest
+
+import UVspecParse
+
+PARSERS = {
+    'loadtxt': lambda buf: np.loadtxt(io.BytesIO(buf)),
+    'parse_columns': UVspecParse.parse_columns,
+    'parse_fromstring': lambda buf: UVspecParse.parse_fromstring(buf.strip()),
+}
+
+
+@pytest.fixture(params=[951, 9501], ids=['1nm', '0.1nm'])
+def uvspec_output(request):
+    """ 'lambda edir' output of uvspec from 250 to 1200 nm """
+    wl = np.linspace(250., 1200., request.param)
+    edir = np.exp(-0.1*(wl/500.)**-4)
+    return ''.join('%11.3f %12.6e\n' % row for row in zip(wl, edir)).encode('ascii'), wl
+
+
+@pytest.mark.parametrize('parser', sorted(PARSERS))
+def test_parse_output(benchmark, uvspec_output, parser):
+    buf, wl = uvspec_output
+    data = benchmark(PARSERS[parser], buf)
+    assert data.shape == (len(wl), 2)
+    assert np.allclose(data[:, 0], wl)
@@ -0,0 +1,21 @@
+"""
+Benchmarks of the spectra synthesis and of the telescope transmission
+"""
+
+import numpy as np
+import pytest
+
+import spectractorsim as sim
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32], ids=['float64', 'float32'])
+def test_spectrumsimgrid_compute(benchmark, atmgrid, spectrum, telescope, disperser, dtype):
+    grid = sim.SpectrumSimGrid(spectrum, atmgrid.atmgrid.astype(dtype), telescope, disperser, spectrum.target, spectrum.header)
+    spectragrid = benchmark(grid.compute)
+    assert spectragrid.shape == atmgrid.atmgrid.shape
+    assert spectragrid.dtype == dtype
+
+
+def test_telescope_load_transmission(benchmark, telescope):
+    transmission = benchmark(telescope.load_transmission)
+    assert transmission(sim.WL).max() > 0
@@ -0,0 +1,88 @@
+"""
+Fixtures of the SpectractorSim benchmarks.
+
+libRadtran is replaced by the analytic fake uvspec of fakeuvspec/, the
+benchmarks thus measure the overheads of SpectractorSim (process
+management, parsing, interpolation, I/O) rather than the radiative transfer.
+FAKE_UVSPEC_DELAY can be set to mimic the cost of the real uvspec.
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+TOPDIR = os.path.dirname(BENCHDIR)
+
+# must be set before libsimulateTranspCTIOScattAbsAer is imported
+os.environ['LIBRADTRANDIR'] = os.path.join(TOPDIR, 'fakeuvspec')
+sys.path.insert(0, TOPDIR)
+sys.path.insert(0, os.path.join(TOPDIR, 'merra2'))
+
+import spectractorsim as sim
+
+
+class AnalyticTarget(object):
+    """ target with a smooth SED, in place of a Spectractor Target and its data files """
+    label = 'analytic'
+
+    def sed(self, lambdas):
+        return 1e-13*(np.asarray(lambdas)/500.)**-2
+
+
+class FlatDisperser(object):
+    """ disperser with a constant efficiency, in place of a Spectractor Hologram """
+    label = 'flat'
+
+    def transmission(self, lambdas):
+        return 0.2*np.ones_like(lambdas)
+
+
+def set_grid_size(monkeypatch, npoints):
+    """ npoints aerosol, pwv and ozone values : npoints**3 atmospheres """
+    monkeypatch.setattr(sim, 'NB_AER_POINTS', npoints)
+    monkeypatch.setattr(sim, 'NB_PWV_POINTS', npoints)
+    monkeypatch.setattr(sim, 'NB_OZ_POINTS', npoints)
+    monkeypatch.setattr(sim, 'NB_ATM_POINTS', npoints**3)
+    monkeypatch.setattr(sim, 'AER_Points', np.linspace(sim.AER_MIN, sim.AER_MAX, npoints))
+    monkeypatch.setattr(sim, 'PWV_Points', np.linspace(sim.PWV_MIN, sim.PWV_MAX, npoints))
+    monkeypatch.setattr(sim, 'OZ_Points', np.linspace(sim.OZ_MIN, sim.OZ_MAX, npoints))
+    return npoints**3
+
+
+@pytest.fixture(params=[2, 3, 4], ids=lambda n: '%dpts' % n**3)
+def grid_size(request, monkeypatch):
+    """ atmospheric grids of 8, 27 and 64 points """
+    return set_grid_size(monkeypatch, request.param)
+
+
+@pytest.fixture
+def atmgrid(monkeypatch):
+    """ an AtmosphereGrid of 27 points filled with smooth transmissions, without running uvspec """
+    set_grid_size(monkeypatch, 3)
+    atm = sim.AtmosphereGrid(1.2, 782.5, 10., 'reduc_20170530_060_spectrum.fits')
+    atm.fill_parameters()
+    atm.atmgrid[1:, sim.index_atm_data:] = np.exp(-0.1*(sim.WL/500.)**-4)*np.linspace(0.9, 1., sim.NB_ATM_POINTS)[:, None]
+    return atm
+
+
+@pytest.fixture
+def telescope():
+    return sim.TelescopeTransmission('RG715')
+
+
+@pytest.fixture
+def spectrum():
+    """ an empty Spectractor Spectrum with an analytic target """
+    from astropy.io import fits
+    spectrum = sim.Spectrum()
+    spectrum.header = fits.Header()
+    spectrum.target = AnalyticTarget()
+    return spectrum
+
+
+@pytest.fixture
+def disperser():
+    return FlatDisperser()
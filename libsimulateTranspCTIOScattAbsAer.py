@@ -8,24 +8,42 @@
 # update : April 2018
 #
 #################################################################
+from __future__ import print_function
 import os
 import re
 import math
+import shutil
+import atexit
+import tempfile
+import hashlib
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 import numpy as np
 import pandas as pd
 from astropy.io import fits
 import sys,getopt
 
 import UVspec
+import UVspecParse
 
 FLAG_DEBUG=False
+FLAG_INMEMORY=False  # stream input and output of uvspec through pipes instead of files
+FLAG_CACHE=False     # keep the simulated transmissions in the on-disk cache CACHEDIR, see UseCache
+FLAG_FASTDIRECT=False  # cheapest solver configuration for the direct beam, see ConfigureFastDirect
+FLAG_FASTDIRECT_NOSOURCE=False  # in fast direct mode, also remove the solar source file
+FASTDIRECT_TOLERANCE=1e-4       # expected agreement of the fast direct mode, limited by the uvspec text output
+# uvspec failures : maximum run time in seconds (None : no limit), number of retries
+UVSPEC_TIMEOUT=float(os.getenv('UVSPEC_TIMEOUT','0')) or None
+UVSPEC_RETRIES=2
+NB_WLCHUNKS=1   # >1 : split the wavelength window of one simulation over NB_WLCHUNKS uvspec running in parallel
 
 # Definitions and configuration
 #-------------------------------------
 
 # LibRadTran installation directory
 home = os.environ['HOME']+'/'       
-libradtranpath = os.getenv('LIBRADTRANDIR')+'/'
+libradtranpath = os.getenv('LIBRADTRANDIR',home+'libRadtran')+'/'
 
 # Filename : RT_LS_pp_us_sa_rt_z15_wv030_oz30.txt
 #          : Prog_Obs_Rte_Atm_proc_Mod_zXX_wv_XX_oz_XX
@@ -42,6 +60,7 @@ WVXX='wv'      # XX index for PWV       :   XX=int(pwv*10)
 OZXX='oz'      # XX index for OZ        :   XX=int(oz/10)
 AEXX='aer'
 AEXX2='aer2'
+PXX='p'        # XX index for pressure  :   XX=int(press*10)
 
 
 #LSST_Altitude = 2.750  # in k meters from astropy package (Cerro Pachon)
@@ -52,50 +71,157 @@ CTIO_Altitude = 2.200  # in k meters from astropy package (Cerro Pachon)
 OBS_Altitude = str(CTIO_Altitude)
 
 
-TOPDIR='simulations/RT/2.0.1/CT'
+# The input and output files of libradtran are written in a scratch workspace
+# private to the process, created in SCRATCHDIR (default : /dev/shm when
+# available, else the temporary directory). WORKSPACE_RETENTION tells what to
+# keep when the workspace is cleaned (CleanSimDir, at exit) :
+# 'none', 'failed' (the workspace if a simulation failed in it) or 'all'.
+# The workspace is always kept once the path of an output file has been returned
+# to the caller (ProcessSimulation, ProcessSimulationaer, ...), see KeepSimDir.
+SCRATCHDIR=os.getenv('SPECTRACTORSIM_SCRATCHDIR')
+WORKSPACE_RETENTION=os.getenv('SPECTRACTORSIM_RETENTION','none')
+_workspace=None
+_workspace_pid=None
+_workspace_failed=False
+_workspace_keep=False
+_workspace_lock=threading.Lock()
+
+# default wavelength window of the simulations in nm
+WLMIN_SIM=250.
+WLMAX_SIM=1200.
+
+# cache of the transmissions, indexed by the hash of the uvspec input and libradtran version
+CACHEDIR=os.getenv('SPECTRACTORSIM_CACHEDIR',home+'.cache/spectractorsim/uvspec')
+LIBRADTRAN_VERSION=None  # forces the libradtran version, read from the installation otherwise
+# files of the installation giving its version : VERSION, or PACKAGE_VERSION in the autoconf files
+LIBRADTRAN_VERSION_FILES=['configure','config.status','config.log']
+LIBRADTRAN_VERSION_UNKNOWN='unknown'
+_libradtran_version=dict()
+_cache_disabled=[]
+
+# zenith optical depths already simulated, indexed by (pwv,ozone,aerosols,pressure),
+# the least recently used are dropped beyond OPTICAL_DEPTH_CACHE_SIZE atmospheres
+ZenithOpticalDepths=OrderedDict()
+OPTICAL_DEPTH_CACHE_SIZE=64
+# expected agreement of the airmass scaling with uvspec, limited by its text output
+AIRMASS_SCALING_TOLERANCE=1e-3
+
+# optical depth components, indexed by (pwv,aerosols), see GetMolecularOpticalDepthsaer
+MolecularOpticalDepths=OrderedDict()
+OZ_REF=300.      # ozone of the decomposition in DU
+PRESS_REF=782.5  # pressure of the decomposition in hPa, typical at CTIO
+# expected agreement of the synthesis with uvspec : ozone absorption is linear in the
+# column and Rayleigh scattering linear in pressure, the residual comes from the
+# pressure dependence of the REPTRAN band absorption of O2 and the other mixed gases
+SYNTHESIS_TOLERANCE=5e-3
+
+# wavelengths of the solar source files, which fix the output sampling of uvspec,
+# indexed by file name, see CheckWavelengthCount
+SourceWavelengths=dict()
+
+# maximum jump of edir between two wavelength chunks at their common wavelength
+SPLIT_TOLERANCE=1e-4
+
+# parameter axes of the transmission tables, in the order of the table dimensions
+TABLE_AXES=['AIRMASS','PWV','OZONE','AEROSOLS','PRESSURE']
+
+def GetScratchDir():
+    """
+    GetScratchDir() : directory where the workspaces are created, SCRATCHDIR if set,
+    otherwise /dev/shm (tmpfs) when it is writable, otherwise the temporary directory
+    """
+    if SCRATCHDIR is not None:
+        ensure_dir(SCRATCHDIR)
+        return SCRATCHDIR
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm',os.W_OK):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def GetWorkspace():
+    """
+    GetWorkspace() : the scratch workspace of the current process, created at the
+    first call. A forked process (e.g. a pool worker) gets its own workspace.
+    """
+    global _workspace,_workspace_pid,_workspace_failed,_workspace_keep
+    with _workspace_lock:
+        if _workspace is None or _workspace_pid!=os.getpid():
+            _workspace=tempfile.mkdtemp(prefix='spectractorsim_%d_' % os.getpid(),dir=GetScratchDir())
+            _workspace_pid=os.getpid()
+            _workspace_failed=False
+            _workspace_keep=False
+        return _workspace
+
+def KeepSimDir():
+    """
+    KeepSimDir() : the files of the workspace of the current process are used after
+    the process exits (their paths were returned to the caller) : CleanSimDir keeps it
+    """
+    global _workspace_keep
+    GetWorkspace()
+    _workspace_keep=True
 
 def CleanSimDir():   
-    os.system("rm -rf simulations")
+    """
+    CleanSimDir() : remove the workspace of the current process, unless
+    WORKSPACE_RETENTION or KeepSimDir asks to keep it. The files of the other
+    processes are untouched.
+    """
+    global _workspace
+    with _workspace_lock:
+        if _workspace is None or _workspace_pid!=os.getpid():
+            return
+        if _workspace_keep or WORKSPACE_RETENTION=='all' or (WORKSPACE_RETENTION=='failed' and _workspace_failed):
+            print('keep the simulation workspace', _workspace)
+            return
+        shutil.rmtree(_workspace,ignore_errors=True)
+        _workspace=None
+
+atexit.register(CleanSimDir)
 
 
 ############################################################################
 def ensure_dir(f):
     d = os.path.dirname(f)
     if not os.path.exists(f):
-        os.makedirs(f)
+        try:
+            os.makedirs(f)
+        except OSError:
+            # another process may have created it in the meantime
+            if not os.path.isdir(f):
+                raise
 #########################################################################
 
 
 def usage0():
-    print "*******************************************************************"
-    print sys.argv[0],' -z <airmass> -w <pwv> -o <oz>'
-    print 'Number of arguments:', len(sys.argv), 'arguments.'
-    print 'Argument List:', str(sys.argv)
+    print("*******************************************************************")
+    print(sys.argv[0],' -z <airmass> -w <pwv> -o <oz>')
+    print('Number of arguments:', len(sys.argv), 'arguments.')
+    print('Argument List:', str(sys.argv))
     
     
-    print "*******************************************************************"
+    print("*******************************************************************")
     
 def usageaer():
-    print "*******************************************************************"
-    print sys.argv[0],' -z <airmass> -w <pwv> -o <oz> -l <wl> -t <tau>'
-    print 'Number of arguments:', len(sys.argv), 'arguments.'
-    print 'Argument List:', str(sys.argv)
+    print("*******************************************************************")
+    print(sys.argv[0],' -z <airmass> -w <pwv> -o <oz> -l <wl> -t <tau>')
+    print('Number of arguments:', len(sys.argv), 'arguments.')
+    print('Argument List:', str(sys.argv))
     
     
-    print "*******************************************************************"    
+    print("*******************************************************************")
 
 
 def usage():
-    print "*******************************************************************"
-    print sys.argv[0],' -z <airmass> -w <pwv> -o <oz> -a<aer> -p <P>'
-    print ' \t - airmass from 1.0 to 3.0, typical z=1 '
-    print ' \t - pwv is precipitable watr vapor in kg per m2 or mm, typical pwv = 5.18 mm'
-    print ' \t - oz ozone in Dobson units from 200 DU to 400 DU'
-    print ' \t - aer means Aerosols, typical a=0.04  '
-    print ' \t - p Pressure in hPa, typical P=775.3 hPa  '
-    print 'Number of arguments:', len(sys.argv), 'arguments.'
-    print 'Argument List:', str(sys.argv)    
-    print "*******************************************************************"
+    print("*******************************************************************")
+    print(sys.argv[0],' -z <airmass> -w <pwv> -o <oz> -a<aer> -p <P>')
+    print(' \t - airmass from 1.0 to 3.0, typical z=1 ')
+    print(' \t - pwv is precipitable watr vapor in kg per m2 or mm, typical pwv = 5.18 mm')
+    print(' \t - oz ozone in Dobson units from 200 DU to 400 DU')
+    print(' \t - aer means Aerosols, typical a=0.04  ')
+    print(' \t - p Pressure in hPa, typical P=775.3 hPa  ')
+    print('Number of arguments:', len(sys.argv), 'arguments.')
+    print('Argument List:', str(sys.argv))
+    print("*******************************************************************")
     
 
 
@@ -129,15 +255,17 @@ def ProcessSimulation(airmass_num,pwv_num,oz_num,press_num):
     """
     
  
-    print '--------------------------------------------'
-    print ' 1) airmass = ', airmass_num
-    print ' 2) pwv = ', pwv_num
-    print ' 3) oz = ', oz_num
-    print ' 4) pressure  = ',press_num
-    print '--------------------------------------------'    
+    print('--------------------------------------------')
+    print(' 1) airmass = ', airmass_num)
+    print(' 2) pwv = ', pwv_num)
+    print(' 3) oz = ', oz_num)
+    print(' 4) pressure  = ',press_num)
+    print('--------------------------------------------')
    
     
-    ensure_dir(TOPDIR)
+    # the output files are read by the caller
+    KeepSimDir()
+    TOPDIR=GetWorkspace()
 
     
     Proc='sa'  # Pure absorption and Rayleigh scattering : Clear sky without aerosols
@@ -332,26 +460,19 @@ def ProcessSimulation(airmass_num,pwv_num,oz_num,press_num):
 
 
 #------------------------------------------------------------------------------
-def ProcessSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num):  
+def ConfigureSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,atmosphere='afglus',wlrange=None):  
     """
-    ProcessSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num) 
-    with aerosol simulation is performed
+    ConfigureSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,atmosphere,wlrange) 
+    build the libradtran input for the aerosol simulation
     default profile
-    """
- 
-    if FLAG_DEBUG:
-        print '--------------------------------------------'
-        print 'ProcessSimulationaer'
-        print ' 1) airmass = ', airmass_num
-        print ' 2) pwv = ', pwv_num
-        print ' 3) oz = ', oz_num
-        print ' 4) aer = ',aer_num
-        print ' 5) pressure =',press_num
-        print '--------------------------------------------'    
-   
+    wlrange is the (min,max) wavelength window of the simulation in nm,
+    default is (WLMIN_SIM,WLMAX_SIM)
     
-    ensure_dir(TOPDIR)
-
+    return:
+        - uvspec : the UVspec object holding the input options
+        - subdir : directory of the simulation relative to the workspace
+        - BaseFilename : the base name of the input and output files
+    """
     
     # build the part 1 of filename
     BaseFilename_part1=Prog+'_'+Obs+'_'+Rte+'_'
@@ -408,8 +529,6 @@ def ProcessSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num):
         molmodel='crs'     
                
 
-
-    	  
     # for simulation select only two atmosphere   
     #theatmospheres = np.array(['afglus','afglms','afglmw','afglt','afglss','afglsw'])
     atmosphere_map=dict()  # map atmospheric names to short names 
@@ -420,136 +539,939 @@ def ProcessSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num):
     atmosphere_map['afglss']='ss'  
     atmosphere_map['afglsw']='sw'  
       
+    atmkey=atmosphere_map[atmosphere]
+       
+    # directory of the simulation, it depends on the atmosphere
+    subdir=Rte+'/'+atmkey+'/'+Proc+'/'+Mod
+    
+    
+    # loop on molecular model resolution
+    #molecularresolution = np.array(['COARSE','MEDIUM','FINE']) 
+    # select only COARSE Model
+    molecularresolution = np.array(['COARSE'])    
+    for molres in molecularresolution:
+        if molres=='COARSE':
+            molresol ='coarse'
+        elif molres=='MEDIUM':
+            molresol ='medium'
+        else:
+            molresol ='fine'
+       
+    
+    #water vapor   
+    pwv_val=pwv_num
+    pwv_str='H2O '+str(pwv_val)+ ' MM'
+    wvfileindex=int(10*pwv_val)
+    
+    #aerosols
+   
+       
+    # airmass
+    airmass=airmass_num
+    amfileindex=int(airmass_num*10)
+    
+    # Ozone    
+    oz_str='O3 '+str(oz_num)+ ' DU'
+    ozfileindex=int(oz_num/10.)
+    
+        
+    # Pressure
+    pressfileindex=int(press_num*10.)
+        
+    BaseFilename=BaseFilename_part1+atmkey+'_'+Proc+'_'+Mod+'_z'+str(amfileindex)+'_'+WVXX+str(wvfileindex) +'_'+OZXX+str(ozfileindex)+'_'+AEXX+str(aer_index)+'_'+PXX+str(pressfileindex)
+                
+    uvspec = UVspec.UVspec()
+    uvspec.tags = dict(airmass=airmass_num,pwv=pwv_num,ozone=oz_num,aerosols=aer_num,pressure=press_num)
+    uvspec.inp["data_files_path"]  =  libradtranpath+'data'
+            
+    uvspec.inp["atmosphere_file"] = libradtranpath+'data/atmmod/'+atmosphere+'.dat'
+    uvspec.inp["albedo"]           = '0.2'
+
+    uvspec.inp["rte_solver"] = rte_eq
+        
+        
+            
+    if Mod == 'rt':
+        uvspec.inp["mol_abs_param"] = molmodel + ' ' + molresol
+    else:
+        uvspec.inp["mol_abs_param"] = molmodel
+
+    # Convert airmass into zenith angle 
+    am=airmass
+    sza=math.acos(1./am)*180./math.pi
+
+    # Should be no_absorption
+    if runtype=='aerosol_default':
+        uvspec.inp["aerosol_default"] = ''
+    elif runtype=='aerosol_special':
+        uvspec.inp["aerosol_default"] = ''
+        uvspec.inp["aerosol_set_tau_at_wvl"] = aerosol_string
+               
+    if runtype=='no_scattering':
+        uvspec.inp["no_scattering"] = ''
+    if runtype=='no_absorption':
+        uvspec.inp["no_absorption"] = ''
+ 
+    # set up the ozone value               
+    uvspec.inp["mol_modify"] = pwv_str
+    uvspec.inp["mol_modify2"] = oz_str
+    
+    # rescale pressure   if reasonable pressure values are provided
+    if press_num>600. and press_num<1015.:
+        uvspec.inp["pressure"] = press_num
+    else:
+        print("creazy pressure p=",press_num, ' hPa')
+                
+            
+    uvspec.inp["output_user"] = 'lambda edir'
+    uvspec.inp["altitude"] = OBS_Altitude   # Altitude LSST observatory
+    uvspec.inp["source"] = 'solar '+libradtranpath+'data/solar_flux/kurudz_1.0nm.dat'
+    #uvspec.inp["source"] = 'solar '+libradtranpath+'data/solar_flux/kurudz_0.1nm.dat'
+    uvspec.inp["sza"]        = str(sza)
+    uvspec.inp["phi0"]       = '0'
+    if wlrange is None:
+        wlrange=(WLMIN_SIM,WLMAX_SIM)
+    uvspec.inp["wavelength"]       = '%.1f %.1f' % tuple(wlrange)
+    uvspec.inp["output_quantity"] = 'reflectivity' #'transmittance' #
+#   uvspec.inp["verbose"] = ''
+    uvspec.inp["quiet"] = ''
+    
+    if FLAG_FASTDIRECT:
+        ConfigureFastDirect(uvspec)
+
+    return uvspec,subdir,BaseFilename
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def ConfigureFastDirect(uvspec):  
+    """
+    ConfigureFastDirect(uvspec) 
+    change the uvspec input to the cheapest configuration giving the same edir.
+    The direct beam is the Beer-Lambert attenuation of the solar beam, it does not
+    depend on the solver of the diffuse radiation nor on the surface albedo :
+        - the two-stream solver replaces disort
+        - the albedo is removed
+        - the solar source file is removed if FLAG_FASTDIRECT_NOSOURCE is set : edir
+          is then the ratio to a unit source. It is kept by default because REPTRAN
+          averages its representative wavelengths with solar flux weights.
+    CompareFastDirectaer checks the equivalence with the full configuration.
+    """
+    if uvspec.inp["rte_solver"]=='disort':
+        uvspec.inp["rte_solver"] = 'twostr'
+    elif uvspec.inp["rte_solver"]=='sdisort':
+        uvspec.inp["rte_solver"] = 'twostr'
+        uvspec.inp["pseudospherical"] = ''
+    uvspec.inp.pop("albedo",None)
+    if FLAG_FASTDIRECT_NOSOURCE:
+        uvspec.inp["source"] = 'solar'
+
+#------------------------------------------------------------------------------
+def CompareFastDirectaer(airmass_num,pwv_num,oz_num,aer_num,press_num):  
+    """
+    CompareFastDirectaer(airmass_num,pwv_num,oz_num,aer_num,press_num) 
+    run the simulation with and without FLAG_FASTDIRECT
+    
+    return:
+        - maxdiff : maximum absolute difference of the transmissions
+    """
+    global FLAG_FASTDIRECT
+    flag=FLAG_FASTDIRECT
+    try:
+        FLAG_FASTDIRECT=False
+        wl,atm=GetTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num)
+        FLAG_FASTDIRECT=True
+        wl_f,atm_f=GetTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num)
+    finally:
+        FLAG_FASTDIRECT=flag
+    if not np.array_equal(wl,wl_f):
+        raise UVspec.UVspecOutputError('the fast direct mode changes the wavelength sampling')
+    maxdiff=np.max(np.abs(atm-atm_f))
+    if maxdiff>FASTDIRECT_TOLERANCE:
+        print('CompareFastDirectaer : fast direct mode differs by ',maxdiff,' more than ',FASTDIRECT_TOLERANCE)
+    return maxdiff
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def GetAtmospheresaer():
+    """
+    GetAtmospheresaer()
+    return the list of libradtran atmosphere models selected by Atm
+    """
     theatmospheres= []
     for skyindex in Atm:
         if re.search('us',skyindex):
             theatmospheres.append('afglus')
         if re.search('sw',skyindex):
             theatmospheres.append('afglsw')
-            
-   
+    return theatmospheres
+
+#------------------------------------------------------------------------------
+def ProcessSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange=None):  
+    """
+    ProcessSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange) 
+    with aerosol simulation is performed
+    default profile
+    """
+ 
+    if FLAG_DEBUG:
+        print('--------------------------------------------')
+        print('ProcessSimulationaer')
+        print(' 1) airmass = ', airmass_num)
+        print(' 2) pwv = ', pwv_num)
+        print(' 3) oz = ', oz_num)
+        print(' 4) aer = ',aer_num)
+        print(' 5) pressure =',press_num)
+        print('--------------------------------------------')
    
+    
+    # the output files are read by the caller
+    KeepSimDir()
+    out,wl,atm=RunSimulationFilesaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange)
+        
+    OUTPUTDIR,outputFilename=os.path.split(out)
+    return OUTPUTDIR,outputFilename
 
+#------------------------------------------------------------------------------
+def RunSimulationFilesaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange=None):  
+    """
+    RunSimulationFilesaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange) 
+    run the aerosol simulation through input and output files in the workspace
+    
+    return:
+        - the output file of the last atmosphere
+        - wl, atm : its wavelengths and direct beam transmission
+    """
     # 1) LOOP ON ATMOSPHERE
-    for atmosphere in theatmospheres:
-        #if atmosphere != 'afglus':  # just take us standard sky
-        #    break
-        atmkey=atmosphere_map[atmosphere]
-       
-        # manage input and output directories and vary the ozone
-        TOPDIR2=TOPDIR+'/'+Rte+'/'+atmkey+'/'+Proc+'/'+Mod
-        ensure_dir(TOPDIR2)
-        INPUTDIR=TOPDIR2+'/'+'in'
-        ensure_dir(INPUTDIR)
-        OUTPUTDIR=TOPDIR2+'/'+'out'
-        ensure_dir(OUTPUTDIR)
+    for atmosphere in GetAtmospheresaer():
+        uvspec,subdir,BaseFilename=ConfigureSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,atmosphere,wlrange)
+        inp,out=WriteSimulationInput(uvspec,subdir,BaseFilename)
+        wl,atm=RunSimulation(uvspec,inp,out)
+    return out,wl,atm
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def PlanSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,atmosphere='afglus',topdir=None,basename=None,wlrange=None):  
+    """
+    PlanSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,atmosphere,topdir,basename,wlrange) 
+    write the input file of the aerosol simulation, uvspec is not run
     
+    input:
+        - topdir : top directory of the simulation files, default is the workspace GetWorkspace()
+        - basename : base name of the files, default is the name built from the parameters
     
-        # loop on molecular model resolution
-        #molecularresolution = np.array(['COARSE','MEDIUM','FINE']) 
-        # select only COARSE Model
-        molecularresolution = np.array(['COARSE'])    
-        for molres in molecularresolution:
-            if molres=='COARSE':
-                molresol ='coarse'
-            elif molres=='MEDIUM':
-                molresol ='medium'
-            else:
-                molresol ='fine'
-           
-        
-        #water vapor   
-        pwv_val=pwv_num
-        pwv_str='H2O '+str(pwv_val)+ ' MM'
-        wvfileindex=int(10*pwv_val)
-        
-        #aerosols
-       
-           
-        # airmass
-        airmass=airmass_num
-        amfileindex=int(airmass_num*10)
-        
-        # Ozone    
-        oz_str='O3 '+str(oz_num)+ ' DU'
-        ozfileindex=int(oz_num/10.)
-        
-            
-        BaseFilename=BaseFilename_part1+atmkey+'_'+Proc+'_'+Mod+'_z'+str(amfileindex)+'_'+WVXX+str(wvfileindex) +'_'+OZXX+str(ozfileindex)+'_'+AEXX+str(aer_index)                   
-                    
-        verbose=FLAG_DEBUG
+    return:
+        - inp : the uvspec input file
+        - out : the output file expected from uvspec
+    """
+    uvspec,subdir,BaseFilename=ConfigureSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,atmosphere,wlrange)
+    if basename is not None:
+        BaseFilename=basename
+    return WriteSimulationInput(uvspec,subdir,BaseFilename,topdir)
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def WriteSimulationInput(uvspec,subdir,BaseFilename,topdir=None):  
+    """
+    WriteSimulationInput(uvspec,subdir,BaseFilename,topdir) 
+    write the input file of a configured simulation in topdir/subdir/in,
+    topdir is by default the workspace of the process
+    
+    return:
+        - inp : the uvspec input file
+        - out : the output file expected from uvspec, in topdir/subdir/out
+    """
+    if topdir is None:
+        topdir=GetWorkspace()
+    ensure_dir(topdir)
+   
+    # manage input and output directories and vary the ozone
+    TOPDIR2=topdir+'/'+subdir
+    ensure_dir(TOPDIR2)
+    INPUTDIR=TOPDIR2+'/'+'in'
+    ensure_dir(INPUTDIR)
+    OUTPUTDIR=TOPDIR2+'/'+'out'
+    ensure_dir(OUTPUTDIR)
         
-        uvspec = UVspec.UVspec()
-        uvspec.inp["data_files_path"]  =  libradtranpath+'data'
+    inputFilename=BaseFilename+'.INP'
+    outputFilename=BaseFilename+'.OUT'
+    inp=os.path.join(INPUTDIR,inputFilename)
+    out=os.path.join(OUTPUTDIR,outputFilename)
                 
-        uvspec.inp["atmosphere_file"] = libradtranpath+'data/atmmod/'+atmosphere+'.dat'
-        uvspec.inp["albedo"]           = '0.2'
+    uvspec.write_input(inp)
     
-        uvspec.inp["rte_solver"] = rte_eq
-            
-            
-                
-        if Mod == 'rt':
-            uvspec.inp["mol_abs_param"] = molmodel + ' ' + molresol
-        else:
-            uvspec.inp["mol_abs_param"] = molmodel
+    return inp,out
 
-        # Convert airmass into zenith angle 
-        am=airmass
-        sza=math.acos(1./am)*180./math.pi
+#---------------------------------------------------------------------------
 
-        # Should be no_absorption
-        if runtype=='aerosol_default':
-            uvspec.inp["aerosol_default"] = ''
-        elif runtype=='aerosol_special':
-            uvspec.inp["aerosol_default"] = ''
-            uvspec.inp["aerosol_set_tau_at_wvl"] = aerosol_string
-                   
-        if runtype=='no_scattering':
-            uvspec.inp["no_scattering"] = ''
-        if runtype=='no_absorption':
-            uvspec.inp["no_absorption"] = ''
-     
-        # set up the ozone value               
-        uvspec.inp["mol_modify"] = pwv_str
-        uvspec.inp["mol_modify2"] = oz_str
-        
-        # rescale pressure   if reasonable pressure values are provided
-        if press_num>600. and press_num<1015.:
-            uvspec.inp["pressure"] = press_num
-        else:
-            print "creazy pressure p=",press_num, ' hPa'
-                    
-                
-        uvspec.inp["output_user"] = 'lambda edir'
-        uvspec.inp["altitude"] = OBS_Altitude   # Altitude LSST observatory
-        uvspec.inp["source"] = 'solar '+libradtranpath+'data/solar_flux/kurudz_1.0nm.dat'
-        #uvspec.inp["source"] = 'solar '+libradtranpath+'data/solar_flux/kurudz_0.1nm.dat'
-        uvspec.inp["sza"]        = str(sza)
-        uvspec.inp["phi0"]       = '0'
-        uvspec.inp["wavelength"]       = '250.0 1200.0'
-        uvspec.inp["output_quantity"] = 'reflectivity' #'transmittance' #
-#       uvspec.inp["verbose"] = ''
-        uvspec.inp["quiet"] = ''
 
-  
+#------------------------------------------------------------------------------
+def IngestSimulationaer(out):  
+    """
+    IngestSimulationaer(out) 
+    read and validate the output file of a simulation run outside of python
+    
+    return:
+        - wl : wavelength array in nm
+        - atm : the direct beam transmission (edir)
+    """
+    if not os.path.isfile(out) or os.path.getsize(out)==0:
+        raise IOError('missing or empty uvspec output file %s' % out)
+    data = UVspecParse.read_columns(out)
+    CheckSimulationOutput(data,out)
+    return data[:,0],data[:,1]
 
-        if "output_quantity" in uvspec.inp.keys():
-            outtextfinal=outtext+'_'+uvspec.inp["output_quantity"]
+#------------------------------------------------------------------------------
+def RunSimulation(uvspec,inp=None,out=None):  
+    """
+    RunSimulation(uvspec,inp,out) 
+    run a configured simulation, through the files inp and out if given,
+    in memory otherwise. Each run is limited to UVSPEC_TIMEOUT seconds and
+    its output validated (CheckSimulationOutput, CheckWavelengthCount).
+    A failed run is retried UVSPEC_RETRIES times before UVspec.UVspecError is raised.
+    
+    return:
+        - wl : wavelength array in nm
+        - atm : the direct beam transmission (edir)
+    """
+    global _workspace_failed
+    name=out if out is not None else 'in memory'
+    for attempt in range(UVSPEC_RETRIES+1):
+        try:
+            if inp is not None:
+                uvspec.run(inp,out,FLAG_DEBUG,path=libradtranpath,timeout=UVSPEC_TIMEOUT)
+                wl,atm=IngestSimulationaer(out)
+            else:
+                data=uvspec.run_inmemory(FLAG_DEBUG,path=libradtranpath,timeout=UVSPEC_TIMEOUT)
+                CheckSimulationOutput(data,name)
+                wl,atm=data[:,0],data[:,1]
+            CheckWavelengthCount(uvspec,wl,name)
+            return wl,atm
+        except (UVspec.UVspecError,IOError,ValueError) as error:
+            print('uvspec run %d/%d failed : %s' % (attempt+1,UVSPEC_RETRIES+1,error))
+            lasterror=error
+    _workspace_failed=True
+    raise UVspec.UVspecError('uvspec failed %d times for %s, last error : %s' % (UVSPEC_RETRIES+1,name,lasterror))
 
-           
-            
-        inputFilename=BaseFilename+'.INP'
-        outputFilename=BaseFilename+'.OUT'
-        inp=os.path.join(INPUTDIR,inputFilename)
-        out=os.path.join(OUTPUTDIR,outputFilename)
-                    
-            
-        uvspec.write_input(inp)
-        uvspec.run(inp,out,verbose,path=libradtranpath)
-        
+#------------------------------------------------------------------------------
+def CheckAsyncSimulation(uvspec,data):  
+    """
+    CheckAsyncSimulation(uvspec,data) 
+    checks of RunSimulation on the output of an UVspecAsync.AsyncUVspecRunner run,
+    its check argument. Raise UVspec.UVspecOutputError if the output is rejected.
+    """
+    CheckSimulationOutput(data,'in memory')
+    CheckWavelengthCount(uvspec,data[:,0],'in memory')
+
+#------------------------------------------------------------------------------
+def GetSourceWavelengths(uvspec):  
+    """
+    GetSourceWavelengths(uvspec) 
+    wavelengths of the solar source file of uvspec, on which uvspec samples its output,
+    read once per file and kept in SourceWavelengths.
+    
+    return:
+        - the wavelengths in nm, None without source file or if the file can not be read
+    """
+    source=uvspec.inp.get('source')
+    if source is None or len(source.split())<2:
+        return None
+    sourcefile=source.split()[1]
+    if sourcefile not in SourceWavelengths:
+        try:
+            SourceWavelengths[sourcefile]=np.loadtxt(sourcefile,usecols=(0,))
+        except (IOError,OSError,ValueError):
+            SourceWavelengths[sourcefile]=None
+    return SourceWavelengths[sourcefile]
+
+#------------------------------------------------------------------------------
+def CheckWavelengthCount(uvspec,wl,name=''):  
+    """
+    CheckWavelengthCount(uvspec,wl,name) 
+    check that a run has the output wavelengths expected from its configuration,
+    to detect truncated outputs : the wavelengths of the solar source file within
+    the wavelength window. When the source file is unknown, check that the output
+    covers the window, within its largest wavelength step.
+    Raise UVspec.UVspecOutputError otherwise.
+    """
+    if uvspec.inp.get('wavelength') is None:
+        return
+    wlmin,wlmax=[float(value) for value in str(uvspec.inp['wavelength']).split()[:2]]
+    sourcewl=GetSourceWavelengths(uvspec)
+    if sourcewl is not None:
+        expected=np.count_nonzero((sourcewl>=wlmin)&(sourcewl<=wlmax))
+        if len(wl)!=expected:
+            raise UVspec.UVspecOutputError('uvspec output %s has %d wavelengths, %d expected' % (name,len(wl),expected))
+        return
+    if len(wl)<2:
+        raise UVspec.UVspecOutputError('uvspec output %s has %d wavelengths' % (name,len(wl)))
+    step=np.max(np.diff(wl))
+    if wl[0]>wlmin+step or wl[-1]<wlmax-step:
+        raise UVspec.UVspecOutputError('uvspec output %s covers %.1f-%.1f nm, %.1f-%.1f nm expected' % (name,wl[0],wl[-1],wlmin,wlmax))
+
+#------------------------------------------------------------------------------
+def CheckSimulationOutput(data,name=''):  
+    """
+    CheckSimulationOutput(data,name) 
+    check that data holds a 'lambda edir' output : two columns, finite values,
+    increasing wavelengths and transmission in [0,1]. Raise UVspec.UVspecOutputError otherwise.
+    """
+    if data.ndim!=2 or data.shape[1]!=2 or data.shape[0]<2:
+        raise UVspec.UVspecOutputError('bad uvspec output shape %s in %s' % (str(data.shape),name))
+    if not np.all(np.isfinite(data)):
+        raise UVspec.UVspecOutputError('non finite values in uvspec output %s' % name)
+    if np.any(np.diff(data[:,0])<=0):
+        raise UVspec.UVspecOutputError('wavelengths are not increasing in uvspec output %s' % name)
+    if np.any(data[:,1]<0) or np.any(data[:,1]>1.0001):
+        raise UVspec.UVspecOutputError('transmission out of [0,1] in uvspec output %s' % name)
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def SimulateTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange=None):  
+    """
+    SimulateTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange) 
+    same simulation as ProcessSimulationaer, but the input is streamed
+    to uvspec and its output is parsed in memory : no file is written
+    
+    return:
+        - wl : wavelength array in nm
+        - atm : the direct beam transmission (edir)
+    """
+    
+    if FLAG_DEBUG:
+        print('--------------------------------------------')
+        print('SimulateTransmissionaer')
+        print(' 1) airmass = ', airmass_num)
+        print(' 2) pwv = ', pwv_num)
+        print(' 3) oz = ', oz_num)
+        print(' 4) aer = ',aer_num)
+        print(' 5) pressure =',press_num)
+        print('--------------------------------------------')
+    
+    for atmosphere in GetAtmospheresaer():
+        uvspec,subdir,BaseFilename=ConfigureSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,atmosphere,wlrange)
+        wl,atm=RunSimulation(uvspec)
         
-    return OUTPUTDIR,outputFilename
+    return wl,atm
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def WavelengthChunks(wlrange=None,nchunks=None):
+    """
+    WavelengthChunks(wlrange,nchunks)
+    split the wavelength window in nchunks (default NB_WLCHUNKS) contiguous windows of similar width.
+    The edges are rounded to the nm of the solar flux grid and shared by
+    the neighbouring windows, the edge wavelength is thus simulated twice.
+    
+    return:
+        - list of (min,max) in nm
+    """
+    if wlrange is None:
+        wlrange=(WLMIN_SIM,WLMAX_SIM)
+    if nchunks is None:
+        nchunks=NB_WLCHUNKS
+    edges=np.unique(np.round(np.linspace(wlrange[0],wlrange[1],nchunks+1)))
+    edges[0],edges[-1]=wlrange[0],wlrange[1]
+    return [(edges[i],edges[i+1]) for i in range(len(edges)-1)]
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def StitchWavelengthChunks(chunks):
+    """
+    StitchWavelengthChunks(chunks)
+    join the (wl,atm) outputs of contiguous wavelength windows. Two neighbouring
+    windows must have common wavelengths where atm agrees within SPLIT_TOLERANCE,
+    they are kept once. Raise UVspec.UVspecOutputError otherwise.
+    
+    return:
+        - wl : wavelength array in nm
+        - atm : the direct beam transmission (edir)
+    """
+    wl,atm=chunks[0]
+    for index,(wlnext,atmnext) in enumerate(chunks[1:]):
+        overlap=np.intersect1d(wl,wlnext)
+        if len(overlap)==0:
+            raise UVspec.UVspecOutputError('no common wavelength between chunks %d and %d : %.1f-%.1f and %.1f-%.1f nm' \
+                             % (index,index+1,wl[0],wl[-1],wlnext[0],wlnext[-1]))
+        jump=np.max(np.abs(atm[np.isin(wl,overlap)]-atmnext[np.isin(wlnext,overlap)]))
+        if jump>SPLIT_TOLERANCE:
+            raise UVspec.UVspecOutputError('discontinuity %g between chunks %d and %d at %.1f nm' % (jump,index,index+1,overlap[0]))
+        keep=wlnext>wl[-1]
+        wl=np.concatenate((wl,wlnext[keep]))
+        atm=np.concatenate((atm,atmnext[keep]))
+    return wl,atm
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def SimulateSplitTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange=None,nchunks=None):
+    """
+    SimulateSplitTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange,nchunks) 
+    same simulation as SimulateTransmissionaer, the wavelength window is split
+    in nchunks windows (default NB_WLCHUNKS) simulated by uvspec processes
+    running in parallel, their outputs are stitched by StitchWavelengthChunks.
+    A single atmosphere then uses several cores.
+    
+    return:
+        - wl : wavelength array in nm
+        - atm : the direct beam transmission (edir)
+    """
+    if nchunks is None:
+        nchunks=NB_WLCHUNKS
+    windows=WavelengthChunks(wlrange,nchunks)
+    
+    def run_chunk(window):
+        return SimulateTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,window)
+    
+    # threads are enough : the work is done in the uvspec processes
+    pool=ThreadPool(len(windows))
+    try:
+        chunks=pool.map(run_chunk,windows)
+    finally:
+        pool.close()
+        pool.join()
+    wl,atm=StitchWavelengthChunks(chunks)
+    CheckSimulationOutput(np.column_stack((wl,atm)),'split in %d chunks' % len(windows))
+    return wl,atm
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def GetTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange=None):  
+    """
+    GetTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange) 
+    run the aerosol simulation, split in wavelength if NB_WLCHUNKS>1,
+    in memory if FLAG_INMEMORY is set,
+    otherwise through input and output files in the workspace (RunSimulationFilesaer)
+    wlrange is the wavelength window of the simulation, see ConfigureSimulationaer
+    
+    return:
+        - wl : wavelength array in nm
+        - atm : the direct beam transmission (edir)
+    """
+    cache=UseCache()
+    if cache:
+        key=CacheKeyaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange)
+        data=LoadCachedTransmission(key)
+        if data is not None:
+            return data[0],data[1]
+    
+    if NB_WLCHUNKS>1:
+        wl,atm = SimulateSplitTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange)
+    elif FLAG_INMEMORY:
+        wl,atm = SimulateTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange)
+    else:
+        out,wl,atm = RunSimulationFilesaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange)
+    
+    if cache:
+        SaveCachedTransmission(key,wl,atm)
+    return wl,atm
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def GetLibRadtranVersion():
+    """
+    GetLibRadtranVersion()
+    return the version of libradtran : LIBRADTRAN_VERSION or the environment variable
+    LIBRADTRAN_VERSION if set, otherwise read from the installation libradtranpath (the file
+    VERSION, or PACKAGE_VERSION in LIBRADTRAN_VERSION_FILES), LIBRADTRAN_VERSION_UNKNOWN if
+    it can not be found
+    """
+    version=os.getenv('LIBRADTRAN_VERSION',LIBRADTRAN_VERSION)
+    if version is not None:
+        return version
+    if libradtranpath not in _libradtran_version:
+        _libradtran_version[libradtranpath]=ReadLibRadtranVersion(libradtranpath)
+    return _libradtran_version[libradtranpath]
+
+#------------------------------------------------------------------------------
+def ReadLibRadtranVersion(path):
+    """
+    ReadLibRadtranVersion(path)
+    return the version of the libradtran installation in path, LIBRADTRAN_VERSION_UNKNOWN
+    if none of its files gives it
+    """
+    versionfile=os.path.join(path,'VERSION')
+    if os.path.isfile(versionfile):
+        f=open(versionfile,'r')
+        version=f.readline().strip()
+        f.close()
+        if version != '':
+            return version
+    pattern=re.compile(r"PACKAGE_VERSION\W+([0-9][\w.-]*)")
+    for name in LIBRADTRAN_VERSION_FILES:
+        filename=os.path.join(path,name)
+        if not os.path.isfile(filename):
+            continue
+        f=open(filename,'r')
+        try:
+            for line in f:
+                found=pattern.search(line)
+                if found is not None:
+                    return found.group(1)
+        finally:
+            f.close()
+    return LIBRADTRAN_VERSION_UNKNOWN
+
+#------------------------------------------------------------------------------
+def UseCache():
+    """
+    UseCache()
+    return True when the transmissions are kept in the cache : FLAG_CACHE is set and the
+    libradtran version, part of the cache keys, is known. Otherwise the entries of an
+    other version could be reused.
+    """
+    if not FLAG_CACHE:
+        return False
+    if GetLibRadtranVersion()==LIBRADTRAN_VERSION_UNKNOWN:
+        if libradtranpath not in _cache_disabled:
+            print('cache disabled : the libradtran version of %s is unknown, set LIBRADTRAN_VERSION' % libradtranpath)
+            _cache_disabled.append(libradtranpath)
+        return False
+    return True
+
+#------------------------------------------------------------------------------
+def CacheKeyaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange=None):
+    """
+    CacheKeyaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange)
+    return the cache key of the aerosol simulation : the hash of the
+    complete uvspec input together with the libradtran version
+    """
+    version=GetLibRadtranVersion()
+    keys=[]
+    for atmosphere in GetAtmospheresaer():
+        uvspec,subdir,BaseFilename=ConfigureSimulationaer(airmass_num,pwv_num,oz_num,aer_num,press_num,atmosphere,wlrange)
+        keys.append(uvspec.input_hash(version))
+    return '_'.join(keys)
+
+#------------------------------------------------------------------------------
+def GetConfigurationHash():
+    """
+    GetConfigurationHash()
+    return the sha1 of the uvspec inputs of a reference atmosphere (airmass 1, OZ_REF,
+    PRESS_REF, no water vapor nor aerosols) and of the libradtran version : it changes
+    with the model configuration (Atm, Mod, Rte, Proc, OBS_Altitude, REPTRAN resolution,
+    source file), the simulations of two configurations with the same hash agree
+    """
+    key=CacheKeyaer(1.,0.,OZ_REF,0.,PRESS_REF)
+    return hashlib.sha1(key.encode('ascii')).hexdigest()
+
+#------------------------------------------------------------------------------
+def CacheFilename(key):
+    """
+    CacheFilename(key) : file of the cache entry key, entries are spread in
+    sub-directories named by the first two characters of the key 
+    """
+    return os.path.join(CACHEDIR,key[:2],key+'.npy')
+
+#------------------------------------------------------------------------------
+def LoadCachedTransmission(key):
+    """
+    LoadCachedTransmission(key)
+    return the array (wl,atm) stored in the cache for key, None if not in the cache
+    """
+    filename=CacheFilename(key)
+    if not os.path.isfile(filename):
+        return None
+    try:
+        data=np.load(filename)
+    except (IOError,ValueError):
+        # truncated or corrupted entry, it is simulated again 
+        return None
+    if FLAG_DEBUG:
+        print('LoadCachedTransmission : ',filename)
+    return data
+
+#------------------------------------------------------------------------------
+def SaveCachedTransmission(key,wl,atm):
+    """
+    SaveCachedTransmission(key,wl,atm)
+    store the arrays wl and atm in the cache for key. The entry is first written
+    in a temporary file then renamed, so that concurrent processes never read
+    a partial entry.
+    """
+    filename=CacheFilename(key)
+    ensure_dir(os.path.dirname(filename))
+    tmpfilename=filename[:-4]+'.%d.tmp.npy' % os.getpid()
+    np.save(tmpfilename,np.vstack((wl,atm)))
+    os.rename(tmpfilename,filename)
+
+#------------------------------------------------------------------------------
+def CleanCache():   
+    """
+    CleanCache() : remove all the entries of the transmission cache
+    """
+    shutil.rmtree(CACHEDIR,ignore_errors=True)
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def ZenithOpticalDepthKey(pwv_num,oz_num,aer_num,press_num,wlrange=None):
+    """
+    ZenithOpticalDepthKey(pwv_num,oz_num,aer_num,press_num,wlrange)
+    key of an atmosphere in ZenithOpticalDepths
+    """
+    return (pwv_num,oz_num,aer_num,press_num,wlrange)
+
+#------------------------------------------------------------------------------
+def GetZenithOpticalDepthaer(pwv_num,oz_num,aer_num,press_num,wlrange=None):  
+    """
+    GetZenithOpticalDepthaer(pwv_num,oz_num,aer_num,press_num,wlrange) 
+    vertical optical depth of the atmosphere from one simulation at zenith (airmass 1).
+    The results are kept in ZenithOpticalDepths, each atmosphere is simulated once.
+    
+    return:
+        - wl : wavelength array in nm
+        - tau : vertical optical depth of the direct beam, inf where the transmission is 0
+    """
+    key=ZenithOpticalDepthKey(pwv_num,oz_num,aer_num,press_num,wlrange)
+    found=GetOpticalDepths(ZenithOpticalDepths,key)
+    if found is None:
+        wl,atm=GetTransmissionaer(1.,pwv_num,oz_num,aer_num,press_num,wlrange)
+        with np.errstate(divide='ignore'):
+            tau=-np.log(atm)
+        found=KeepOpticalDepths(ZenithOpticalDepths,key,(wl,tau))
+    return found
+
+#------------------------------------------------------------------------------
+def GetOpticalDepths(cache,key):
+    """
+    GetOpticalDepths(cache,key) : entry of ZenithOpticalDepths or MolecularOpticalDepths,
+    marked as the most recently used, None if absent
+    """
+    if key not in cache:
+        return None
+    value=cache.pop(key)
+    cache[key]=value
+    return value
+
+def KeepOpticalDepths(cache,key,value):
+    """
+    KeepOpticalDepths(cache,key,value) : store an entry of ZenithOpticalDepths or
+    MolecularOpticalDepths, dropping the least recently used beyond OPTICAL_DEPTH_CACHE_SIZE
+    """
+    cache[key]=value
+    while len(cache)>OPTICAL_DEPTH_CACHE_SIZE:
+        cache.popitem(last=False)
+    return value
+
+def ClearOpticalDepths():
+    """
+    ClearOpticalDepths() : empty ZenithOpticalDepths and MolecularOpticalDepths,
+    once the atmospheres of a grid or an exposure are simulated
+    """
+    ZenithOpticalDepths.clear()
+    MolecularOpticalDepths.clear()
+
+#------------------------------------------------------------------------------
+def TransmissionFromOpticalDepth(tau,airmass_num):  
+    """
+    TransmissionFromOpticalDepth(tau,airmass_num) 
+    direct beam transmission at airmass_num : Beer-Lambert law in plane parallel geometry
+    """
+    return np.exp(-tau*airmass_num)
+
+#------------------------------------------------------------------------------
+def GetScaledTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange=None):  
+    """
+    GetScaledTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange) 
+    same result as GetTransmissionaer, but derived from the zenith optical depth
+    of the atmosphere : only one uvspec run per (pwv,ozone,aerosols,pressure).
+    
+    The edir output of the plane parallel solver (Rte='pp') attenuates the direct
+    beam as exp(-tau/cos(sza)) with airmass=1/cos(sza), so the scaling is exact up
+    to the precision of the uvspec text output (see ValidateAirmassScalingaer).
+    
+    return:
+        - wl : wavelength array in nm
+        - atm : the direct beam transmission (edir)
+    """
+    if Rte != 'pp':
+        raise ValueError('airmass scaling requires the plane parallel geometry, Rte=%s' % Rte)
+    wl,tau=GetZenithOpticalDepthaer(pwv_num,oz_num,aer_num,press_num,wlrange)
+    return wl,TransmissionFromOpticalDepth(tau,airmass_num)
+
+#------------------------------------------------------------------------------
+def ValidateAirmassScalingaer(airmasses,pwv_num,oz_num,aer_num,press_num):  
+    """
+    ValidateAirmassScalingaer(airmasses,pwv_num,oz_num,aer_num,press_num) 
+    compare the airmass scaling with real uvspec runs at each airmass
+    
+    return:
+        - maxdiff : array of the maximum absolute difference of the transmissions for each airmass
+    """
+    maxdiff=np.zeros(len(airmasses))
+    for idx,airmass in enumerate(airmasses):
+        wl,atm=GetTransmissionaer(airmass,pwv_num,oz_num,aer_num,press_num)
+        wl_s,atm_s=GetScaledTransmissionaer(airmass,pwv_num,oz_num,aer_num,press_num)
+        if not np.array_equal(wl,wl_s):
+            raise UVspec.UVspecOutputError('uvspec wavelength sampling changes with the airmass')
+        maxdiff[idx]=np.max(np.abs(atm-atm_s))
+        if FLAG_DEBUG:
+            print('ValidateAirmassScalingaer : airmass = ',airmass,' max |diff| = ',maxdiff[idx])
+    if np.any(maxdiff>AIRMASS_SCALING_TOLERANCE):
+        print('ValidateAirmassScalingaer : airmass scaling differs from uvspec by more than ',AIRMASS_SCALING_TOLERANCE)
+    return maxdiff
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def GetMolecularOpticalDepthsaer(pwv_num,aer_num,wlrange=None):  
+    """
+    GetMolecularOpticalDepthsaer(pwv_num,aer_num,wlrange) 
+    decompose the zenith optical depth at the reference ozone OZ_REF and pressure
+    PRESS_REF into its components, from the zenith simulations :
+        - base : pwv_num, OZ_REF, no aerosols
+        - without ozone, without water vapor, with aerosols aer_num
+    The results are kept in MolecularOpticalDepths.
+    
+    return:
+        - wl : wavelength array in nm
+        - taus : dictionary of the vertical optical depths
+            'ozone' : ozone for OZ_REF
+            'h2o' : water vapor for pwv_num
+            'pressure' : Rayleigh scattering and well mixed gases for PRESS_REF
+            'aerosols' : aerosols for aer_num
+    """
+    key=(pwv_num,aer_num,wlrange)
+    found=GetOpticalDepths(MolecularOpticalDepths,key)
+    if found is None:
+        wl,tau_base=GetZenithOpticalDepthaer(pwv_num,OZ_REF,0.,PRESS_REF,wlrange)
+        wl_o3,tau_noo3=GetZenithOpticalDepthaer(pwv_num,0.,0.,PRESS_REF,wlrange)
+        wl_h2o,tau_noh2o=GetZenithOpticalDepthaer(0.,OZ_REF,0.,PRESS_REF,wlrange)
+        wl_aer,tau_aer=GetZenithOpticalDepthaer(pwv_num,OZ_REF,aer_num,PRESS_REF,wlrange)
+        for wl_other in [wl_o3,wl_h2o,wl_aer]:
+            if not np.array_equal(wl,wl_other):
+                raise UVspec.UVspecOutputError('uvspec wavelength sampling changes with the atmosphere')
+        taus=dict()
+        # saturated bands give inf-inf, their transmission remains 0 
+        with np.errstate(invalid='ignore'):
+            taus['ozone']=np.nan_to_num(tau_base-tau_noo3)
+            taus['h2o']=np.nan_to_num(tau_base-tau_noh2o)
+            taus['aerosols']=np.nan_to_num(tau_aer-tau_base)
+            taus['pressure']=tau_base-taus['ozone']-taus['h2o']
+        taus['pressure'][np.isnan(taus['pressure'])]=np.inf
+        found=KeepOpticalDepths(MolecularOpticalDepths,key,(wl,taus))
+    return found
+
+#------------------------------------------------------------------------------
+def GetSynthesizedTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange=None):  
+    """
+    GetSynthesizedTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange) 
+    transmission synthesized from the optical depth components of GetMolecularOpticalDepthsaer :
+        tau = tau_pressure*press/PRESS_REF + tau_ozone*oz/OZ_REF + tau_h2o + tau_aerosols
+    and scaled to the airmass as in GetScaledTransmissionaer.
+    Any ozone column and pressure then costs no uvspec run, the agreement with
+    GetTransmissionaer is checked by ValidateSynthesisaer. 
+    Pressures that libradtran ignores (see ConfigureSimulationaer) are simulated directly.
+    
+    return:
+        - wl : wavelength array in nm
+        - atm : the direct beam transmission (edir)
+    """
+    if not (press_num>600. and press_num<1015.):
+        return GetTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num,wlrange)
+    if Rte != 'pp':
+        raise ValueError('airmass scaling requires the plane parallel geometry, Rte=%s' % Rte)
+    wl,taus=GetMolecularOpticalDepthsaer(pwv_num,aer_num,wlrange)
+    tau=taus['pressure']*(press_num/PRESS_REF)+taus['ozone']*(oz_num/OZ_REF)+taus['h2o']+taus['aerosols']
+    return wl,TransmissionFromOpticalDepth(tau,airmass_num)
+
+#------------------------------------------------------------------------------
+def ValidateSynthesisaer(airmass_num,pwv_num,oz_values,aer_num,press_values):  
+    """
+    ValidateSynthesisaer(airmass_num,pwv_num,oz_values,aer_num,press_values) 
+    compare the synthesized transmissions with uvspec runs for all the ozone
+    and pressure values
+    
+    return:
+        - maxdiff : array (len(oz_values),len(press_values)) of the maximum absolute
+            difference of the transmissions
+    """
+    maxdiff=np.zeros((len(oz_values),len(press_values)))
+    for i,oz_num in enumerate(oz_values):
+        for j,press_num in enumerate(press_values):
+            wl,atm=GetTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num)
+            wl_s,atm_s=GetSynthesizedTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num)
+            maxdiff[i,j]=np.max(np.abs(atm-atm_s))
+            if FLAG_DEBUG:
+                print('ValidateSynthesisaer : oz = ',oz_num,' P = ',press_num,' max |diff| = ',maxdiff[i,j])
+    if np.any(maxdiff>SYNTHESIS_TOLERANCE):
+        print('ValidateSynthesisaer : synthesis differs from uvspec by more than ',SYNTHESIS_TOLERANCE)
+    return maxdiff
+
+#---------------------------------------------------------------------------
+
+
+#------------------------------------------------------------------------------
+def BuildTransmissionTable(filename,airmass_points,pwv_points,oz_points,aer_points,press_points):  
+    """
+    BuildTransmissionTable(filename,airmass_points,pwv_points,oz_points,aer_points,press_points) 
+    precompute the transmissions on the grid of all the parameters and save them
+    in the FITS file filename :
+        - primary HDU : float32 array of shape
+          (len(airmass_points),len(pwv_points),len(oz_points),len(aer_points),len(press_points),nb wavelengths)
+        - image HDUs AIRMASS, PWV, OZONE, AEROSOLS, PRESSURE, WAVELENGTH : the axes
+    uvspec runs once per (pwv,ozone,aerosols,pressure) at zenith, the airmass axis
+    is derived with the airmass scaling (GetScaledTransmissionaer).
+    The table is used by spectractorsim.TableAtmosphere, without libradtran.
+    
+    return:
+        - the table array
+    """
+    axes=[np.asarray(airmass_points,dtype=float),np.asarray(pwv_points,dtype=float),
+          np.asarray(oz_points,dtype=float),np.asarray(aer_points,dtype=float),
+          np.asarray(press_points,dtype=float)]
+    for press_num in axes[4]:
+        if not (press_num>600. and press_num<1015.):
+            raise ValueError('pressure %f hPa is ignored by libradtran' % press_num)
+    
+    wl=None
+    table=None
+    for ipwv,pwv_num in enumerate(axes[1]):
+        for ioz,oz_num in enumerate(axes[2]):
+            for iaer,aer_num in enumerate(axes[3]):
+                for ip,press_num in enumerate(axes[4]):
+                    for iam,airmass_num in enumerate(axes[0]):
+                        wl_s,atm=GetScaledTransmissionaer(airmass_num,pwv_num,oz_num,aer_num,press_num)
+                        if table is None:
+                            wl=wl_s
+                            table=np.zeros([len(axis) for axis in axes]+[len(wl)],dtype=np.float32)
+                        elif not np.array_equal(wl,wl_s):
+                            raise UVspec.UVspecOutputError('uvspec wavelength sampling changes with the atmosphere')
+                        table[iam,ipwv,ioz,iaer,ip,:]=atm
+                    # the zenith optical depth is not needed anymore
+                    ZenithOpticalDepths.pop(ZenithOpticalDepthKey(pwv_num,oz_num,aer_num,press_num),None)
+    
+    hdr=fits.Header()
+    hdr['ATMSIM'] = "libradtran"
+    hdr['SIMVERS'] = GetLibRadtranVersion()
+    hdr['SIMHASH'] = GetConfigurationHash()
+    hdr['OBSALT'] = CTIO_Altitude
+    hdulist=fits.HDUList([fits.PrimaryHDU(table,header=hdr)])
+    for name,axis in zip(TABLE_AXES+['WAVELENGTH'],axes+[wl]):
+        hdulist.append(fits.ImageHDU(axis,name=name))
+    hdulist.writeto(filename,overwrite=True)
+    return table
 
 #---------------------------------------------------------------------------
 
@@ -562,17 +1484,19 @@ def ProcessSimulationaer1(airmass_num,pwv_num,oz_num,wl0_num,tau0_num,press_num)
     default profile
     """
  
-    print '--------------------------------------------'
-    print ' 1) airmass = ', airmass_num
-    print ' 2) pwv = ', pwv_num
-    print ' 3) oz = ', oz_num
-    print ' 4) wl0 = ',wl0_num
-    print ' 5) tau0 = ',tau0_num
-    print ' 6) pressure =',press_num
-    print '--------------------------------------------'    
+    print('--------------------------------------------')
+    print(' 1) airmass = ', airmass_num)
+    print(' 2) pwv = ', pwv_num)
+    print(' 3) oz = ', oz_num)
+    print(' 4) wl0 = ',wl0_num)
+    print(' 5) tau0 = ',tau0_num)
+    print(' 6) pressure =',press_num)
+    print('--------------------------------------------')
    
     
-    ensure_dir(TOPDIR)
+    # the output files are read by the caller
+    KeepSimDir()
+    TOPDIR=GetWorkspace()
 
     
     # build the part 1 of filename
@@ -737,7 +1661,7 @@ def ProcessSimulationaer1(airmass_num,pwv_num,oz_num,wl0_num,tau0_num,press_num)
         if press_num>600. and press_num<1015.:
             uvspec.inp["pressure"] = press_num
         else:
-            print "creazy pressure p=",press_num, ' hPa'
+            print("creazy pressure p=",press_num, ' hPa')
                     
                 
         uvspec.inp["output_user"] = 'lambda edir'
@@ -782,17 +1706,19 @@ def ProcessSimulationaer2(airmass_num,pwv_num,oz_num,alpha_num,beta_num,press_nu
     default profile
     """
  
-    print '--------------------------------------------'
-    print ' 1) airmass = ', airmass_num
-    print ' 2) pwv = ', pwv_num
-    print ' 3) oz = ', oz_num
-    print ' 4) alpha = ',alpha_num
-    print ' 5) beta = ',beta_num
-    print ' 6) pressure =',press_num
-    print '--------------------------------------------'    
+    print('--------------------------------------------')
+    print(' 1) airmass = ', airmass_num)
+    print(' 2) pwv = ', pwv_num)
+    print(' 3) oz = ', oz_num)
+    print(' 4) alpha = ',alpha_num)
+    print(' 5) beta = ',beta_num)
+    print(' 6) pressure =',press_num)
+    print('--------------------------------------------')
    
     
-    ensure_dir(TOPDIR)
+    # the output files are read by the caller
+    KeepSimDir()
+    TOPDIR=GetWorkspace()
 
     
     # build the part 1 of filename
@@ -961,7 +1887,7 @@ def ProcessSimulationaer2(airmass_num,pwv_num,oz_num,alpha_num,beta_num,press_nu
         if press_num>600. and press_num<1015.:
             uvspec.inp["pressure"] = press_num
         else:
-             print "creazy pressure p=",press_num, ' hPa'
+             print("creazy pressure p=",press_num, ' hPa')
                     
                 
         uvspec.inp["output_user"] = 'lambda edir'
@@ -1034,13 +1960,13 @@ if __name__ == "__main__":
         try:
             opts, args = getopt.getopt(sys.argv[1:],"hz:w:o:p:",["z=","w=","o=","p="])
         except getopt.GetoptError:
-            print ' Exception bad getopt with :: '+sys.argv[0]+ ' -z <airmass> -w <pwv> -o <oz> -p <press>'
+            print(' Exception bad getopt with :: '+sys.argv[0]+ ' -z <airmass> -w <pwv> -o <oz> -p <press>')
             sys.exit(2)
         
     
         
-        print 'opts = ',opts
-        print 'args = ',args    
+        print('opts = ',opts)
+        print('args = ',args)
         
         
         for opt, arg in opts:
@@ -1056,15 +1982,15 @@ if __name__ == "__main__":
             elif opt in ("-p", "--pr"):
                 press_str = arg 
             else:
-                print 'Do not understand arguments : ',argv
+                print('Do not understand arguments : ',argv)
             
          
-        print '--------------------------------------------'     
-        print '1) airmass-str = ', airmass_str
-        print '2) pwv-str = ', pwv_str
-        print "3) oz-str = ", oz_str  
-        print "4) pr = ", press_str
-        print '--------------------------------------------' 
+        print('--------------------------------------------')
+        print('1) airmass-str = ', airmass_str)
+        print('2) pwv-str = ', pwv_str)
+        print("3) oz-str = ", oz_str)
+        print("4) pr = ", press_str)
+        print('--------------------------------------------')
 
         if airmass_str=="":
             usage()
@@ -1091,55 +2017,55 @@ if __name__ == "__main__":
         oz_nb=float(oz_str)	
         press_nb=float(press_str)
         
-        print '--------------------------------------------'     
-        print '1) airmass  = ', airmass_nb
-        print '2) pwv = ', pwv_nb
-        print "3) oz = ", oz_nb
-        print "4) press = ", press_nb
-        print '--------------------------------------------' 
+        print('--------------------------------------------')
+        print('1) airmass  = ', airmass_nb)
+        print('2) pwv = ', pwv_nb)
+        print("3) oz = ", oz_nb)
+        print("4) press = ", press_nb)
+        print('--------------------------------------------')
         
     
         if airmass_nb<1 or airmass_nb >3 :
-            print "bad airmass value z=",airmass_nb
+            print("bad airmass value z=",airmass_nb)
             sys.exit()
             
         if pwv_nb<0 or pwv_nb >50 :
-            print "bad PWV value pwv=",pwv_nb
+            print("bad PWV value pwv=",pwv_nb)
             sys.exit()
         
         if oz_nb<0 or oz_nb >600 :
-            print "bad Ozone value oz=",oz_nb
+            print("bad Ozone value oz=",oz_nb)
             sys.exit()
             
         
         
         if press_nb<0 or press_nb >1500 :
-            print "bad Pressure value press=",press_nb
+            print("bad Pressure value press=",press_nb)
             sys.exit()
         
         
         # do the simulation now 
-        print "values are OK"
+        print("values are OK")
     
         path, outputfile=ProcessSimulation(airmass_nb,pwv_nb,oz_nb,press_nb)
     
-        print '*****************************************************'
-        print ' path       = ', path
-        print ' outputfile =  ', outputfile 
-        print '*****************************************************'   
+        print('*****************************************************')
+        print(' path       = ', path)
+        print(' outputfile =  ', outputfile)
+        print('*****************************************************')
     
     
     else:
         try:
             opts, args = getopt.getopt(sys.argv[1:],"hz:w:o:a:p:",["z=","w=","o=","a=","p="])
         except getopt.GetoptError:
-            print ' Exception bad getopt with :: '+sys.argv[0]+ ' -z <airmass> -w <pwv> -o <oz> -a <aer> -p <press>'
+            print(' Exception bad getopt with :: '+sys.argv[0]+ ' -z <airmass> -w <pwv> -o <oz> -a <aer> -p <press>')
             sys.exit(2)
         
     
         
-        print 'opts = ',opts
-        print 'args = ',args    
+        print('opts = ',opts)
+        print('args = ',args)
         
         
         for opt, arg in opts:
@@ -1157,16 +2083,16 @@ if __name__ == "__main__":
             elif opt in ("-p", "--pr"):
                 press_str = arg 
             else:
-                print 'Do not understand arguments : ',argv
+                print('Do not understand arguments : ',argv)
             
          
-        print '--------------------------------------------'     
-        print '1) airmass-str = ', airmass_str
-        print '2) pwv-str = ', pwv_str
-        print "3) oz-str = ", oz_str  
-        print "4) aer = ", aer_str
-        print "5) pr = ", press_str
-        print '--------------------------------------------' 
+        print('--------------------------------------------')
+        print('1) airmass-str = ', airmass_str)
+        print('2) pwv-str = ', pwv_str)
+        print("3) oz-str = ", oz_str)
+        print("4) aer = ", aer_str)
+        print("5) pr = ", press_str)
+        print('--------------------------------------------')
 
         if airmass_str=="":
             usage()
@@ -1196,46 +2122,46 @@ if __name__ == "__main__":
         aer_nb=float(aer_str)
         press_nb=float(press_str)
         
-        print '--------------------------------------------'     
-        print '1) airmass  = ', airmass_nb
-        print '2) pwv = ', pwv_nb
-        print "3) oz = ", oz_nb
-        print "4) aer = ", aer_nb
-        print "5) press = ", press_nb
-        print '--------------------------------------------' 
+        print('--------------------------------------------')
+        print('1) airmass  = ', airmass_nb)
+        print('2) pwv = ', pwv_nb)
+        print("3) oz = ", oz_nb)
+        print("4) aer = ", aer_nb)
+        print("5) press = ", press_nb)
+        print('--------------------------------------------')
         
     
         if airmass_nb<1 or airmass_nb >3 :
-            print "bad airmass value z=",airmass_nb
+            print("bad airmass value z=",airmass_nb)
             sys.exit()
             
         if pwv_nb<0 or pwv_nb >50 :
-            print "bad PWV value pwv=",pwv_nb
+            print("bad PWV value pwv=",pwv_nb)
             sys.exit()
         
         if oz_nb<0 or oz_nb >600 :
-            print "bad Ozone value oz=",oz_nb
+            print("bad Ozone value oz=",oz_nb)
             sys.exit()
             
         if aer_nb<0 or aer_nb >0.5 :
-            print "bad Aerosol value aer=",aer_nb
+            print("bad Aerosol value aer=",aer_nb)
             sys.exit()
         
         
         if press_nb<0 or press_nb >1500 :
-            print "bad Pressure value press=",press_nb
+            print("bad Pressure value press=",press_nb)
             sys.exit()
         
         
         # do the simulation now 
-        print "values are OK"
+        print("values are OK")
     
         path, outputfile=ProcessSimulationaer(airmass_nb,pwv_nb,oz_nb,aer_nb,press_nb)
     
-        print '*****************************************************'
-        print ' path       = ', path
-        print ' outputfile =  ', outputfile 
-        print '*****************************************************'
+        print('*****************************************************')
+        print(' path       = ', path)
+        print(' outputfile =  ', outputfile)
+        print('*****************************************************')
         
         
 
@@ -6,6 +6,7 @@ Created on Sat Apr 28 17:52:05 2018
 @author: dagoret
 """
 
+from __future__ import print_function
 import numpy as np
 import pandas as pd
 import sys
@@ -31,7 +32,7 @@ def GetStartStoptime(df_ctio_subdir):
         start_time
         stop_time
     """
-    all_datetime_ctio_subdir=pd.to_datetime(df_ctio_subdir.index.get_values())
+    all_datetime_ctio_subdir=pd.to_datetime(df_ctio_subdir.index.values)
     start_time=all_datetime_ctio_subdir[0]
     stop_time=all_datetime_ctio_subdir[-1]
     return start_time,stop_time  
@@ -78,8 +79,8 @@ def GetAtmosphericParameters(timestamp0,df_merra2):
     
     # convert the string into timestamp
     #-------------------------------------
-    all_datetime1_m2=pd.to_datetime(dataset1_m2.index.get_values())
-    all_datetime2_m2=pd.to_datetime(dataset2_m2.index.get_values())
+    all_datetime1_m2=pd.to_datetime(dataset1_m2.index.values)
+    all_datetime2_m2=pd.to_datetime(dataset2_m2.index.values)
     
    
     # get time difference between timestamp = timestamp-merra2-timestamp-ctio
@@ -94,11 +95,11 @@ def GetAtmosphericParameters(timestamp0,df_merra2):
     idx2=np.where(delays2==delays2.min())[0][0]
     
     if False:
-        print 'deltat1 :' ,deltat1[idx1], pd.Timedelta(deltat1[idx1],unit='s')
-        print dataset1_m2.iloc[idx1,:]
+        print('deltat1 :' ,deltat1[idx1], pd.Timedelta(deltat1[idx1],unit='s'))
+        print(dataset1_m2.iloc[idx1,:])
         
-        print 'deltat2 :' ,deltat2[idx2],pd.Timedelta(deltat2[idx2],unit='s')
-        print dataset2_m2.iloc[idx2,:]
+        print('deltat2 :' ,deltat2[idx2],pd.Timedelta(deltat2[idx2],unit='s'))
+        print(dataset2_m2.iloc[idx2,:])
         
     ps=dataset1_m2.iloc[idx1]["ps"]/100. # convert Pa into hecto-Pa
     pwv=dataset1_m2.iloc[idx1]["pwv"]
@@ -107,8 +108,8 @@ def GetAtmosphericParameters(timestamp0,df_merra2):
     clouds=dataset2_m2.iloc[idx2]["TAUTOT"]
     
     if False:
-        print 'idx1=',idx1,' P=',ps,' pwv=',pwv,' ozone =',ozone
-        print 'idx2=',idx2,' aer=',aer, ' , clouds = ',clouds
+        print('idx1=',idx1,' P=',ps,' pwv=',pwv,' ozone =',ozone)
+        print('idx2=',idx2,' aer=',aer, ' , clouds = ',clouds)
     
     return ps,pwv,ozone,aer,clouds,deltat1[idx1]/60.,deltat2[idx2]/60.  
 
@@ -129,7 +130,7 @@ if __name__ == "__main__":
     df_ctio=pd.read_csv(file_logbook_ctio,sep=';')
     df_ctio=df_ctio.reindex(columns=['date','P','T','RH','airmass','seeing','exposure','object','filter','disperser',
                                  'focus','W','subdir','file']).set_index('date').sort_index()
-    all_datetime_ctio=pd.to_datetime(df_ctio.index.get_values())
+    all_datetime_ctio=pd.to_datetime(df_ctio.index.values)
     
     
     # Select a subdir
@@ -138,19 +139,19 @@ if __name__ == "__main__":
     df_ctio_subdir=df_ctio[df_ctio["subdir"]==All_Subdirs[subdir_sel_idx]]
     
     # test the function GetStartStoptime
-    print GetStartStoptime(df_ctio_subdir)
+    print(GetStartStoptime(df_ctio_subdir))
     
     # DateTime of the subdir
-    mydates=pd.to_datetime(df_ctio_subdir.index.get_values())
+    mydates=pd.to_datetime(df_ctio_subdir.index.values)
     
     # select one date
     one_mydates=mydates[5]
     
     # test GetAtmosphericParameters()
-    print GetAtmosphericParameters(one_mydates,df_merra2)
+    print(GetAtmosphericParameters(one_mydates,df_merra2))
     
     for thedate in mydates:
-        print GetAtmosphericParameters(thedate,df_merra2)
+        print(GetAtmosphericParameters(thedate,df_merra2))
     
     
     
@@ -34,6 +34,7 @@ sys.path.append(PATH_GMAOMERRA)
 
 from spectractor import *
 from spectractorsim import *
+import spectractorsim
 import libMerra2 as m2
 
 run_spectractorsim_path = os.path.dirname(__file__)
@@ -109,6 +110,11 @@ df_merra2.head()
 parameters.VERBOSE = False
 parameters.DEBUG = False
 
+# the clearsky and standard atmospheres are the same for many exposures and
+# for every reprocessing : keep the libradtran transmissions in the cache,
+# unused when the libradtran version is unknown (see atmsim.UseCache)
+atmsim.FLAG_CACHE = True
+
 
 def get_image_filename(filename):
     """
@@ -145,9 +151,13 @@ if __name__ == "__main__":
                       help="Write results in given output directory (default: ./tests/).")
     parser.add_option("-i", "--input_directory", dest="input_directory", default="data_30may17",
                       help="Define from where the reconstructued spectra will be taken (default: data_30may17).")
+    parser.add_option("-t", "--table", dest="table", default=None,
+                      help="Interpolate the atmospheric transmissions in this table instead of running libradtran.")
     
     (opts, args) = parser.parse_args()
 
+    if opts.table is not None:
+        spectractorsim.TRANSMISSION_TABLE=opts.table
     
     count =np.sum(All_Subdirs==opts.input_directory)
     if count==1:
@@ -16,6 +16,7 @@ Last updaten : April 6th
 
 """
 
+from __future__ import print_function
 import numpy as np
 import re
 import matplotlib.pyplot as plt
@@ -25,12 +26,23 @@ from matplotlib.ticker import MaxNLocator
 
 import sys,os
 import copy
+import shutil
+import multiprocessing
+import multiprocessing.util
+import pandas as pd
 from astropy.io import fits
 from astropy.coordinates import SkyCoord
 import astropy.units as units
 from astropy import constants as const
 
 from scipy.interpolate import interp1d
+from scipy.interpolate import RegularGridInterpolator
+
+# optional : HDF5 atmospheric grid files
+try:
+    import h5py
+except ImportError:
+    h5py=None
 
 sys.path.append("../Spectractor")
 
@@ -52,6 +64,7 @@ spectractorsim_path = os.path.dirname(__file__)
 
 import libsimulateTranspCTIOScattAbsAer as atmsim
 import libCTIOTransm as ctio
+import UVspec
 #--------------------------------------------------------------------------
 # Telescope parameter
 #
@@ -128,6 +141,99 @@ NB_atm_DATA=len(WL)-1
 
 MINFILESIZE=20000
 
+# type of the atmospheric and spectra grids, in memory and in the files :
+# np.float32 halves their size, the libradtran transmissions only have
+# about 4 significant digits
+GRID_DTYPE=np.float64
+
+# number of processes used by AtmosphereGrid.compute (1 means serial)
+NB_WORKERS=1
+
+# settings of spectractorsim and atmsim given to the process pool of AtmosphereGrid.compute :
+# with the spawn and forkserver start methods the workers import the modules again and
+# would otherwise simulate with the default settings
+GRID_WORKER_SETTINGS=('FLAG_AIRMASS_SCALING','FLAG_MOLECULAR_SYNTHESIS')
+ATMSIM_WORKER_SETTINGS=('libradtranpath','FLAG_DEBUG','FLAG_INMEMORY','FLAG_CACHE','CACHEDIR',
+                        'FLAG_FASTDIRECT','FLAG_FASTDIRECT_NOSOURCE','UVSPEC_TIMEOUT','UVSPEC_RETRIES',
+                        'NB_WLCHUNKS','SPLIT_TOLERANCE','WLMIN_SIM','WLMAX_SIM','Atm','Proc','Mod','Rte',
+                        'OZ_REF','PRESS_REF','AIRMASS_SCALING_TOLERANCE','SYNTHESIS_TOLERANCE',
+                        'LIBRADTRAN_VERSION','SCRATCHDIR','WORKSPACE_RETENTION')
+
+# derive the transmission at any airmass from one zenith simulation per atmosphere
+FLAG_AIRMASS_SCALING=False
+# synthesize the ozone and pressure dependence from optical depth components,
+# this also applies the airmass scaling
+FLAG_MOLECULAR_SYNTHESIS=False
+
+# FITS file written by atmsim.BuildTransmissionTable : when given, SpectractorSim
+# interpolates in this table instead of running libradtran
+TRANSMISSION_TABLE=None
+
+# restrict the libradtran simulations to the wavelengths where the telescope
+# transmits, with a margin in nm for the interpolation on WL
+FLAG_TRIM_WAVELENGTH=True
+WLMARGIN=10.
+# the telescope transmits where its transmission is above WLTHRESHOLD times its maximum,
+# the interpolation tails and leakage below are ignored
+WLTHRESHOLD=1e-4
+
+# compute the aerosol axis of the atmospheric grids with the Angstrom law from the simulations
+# without aerosols, see AtmosphereGrid.compute
+FLAG_ANALYTIC_AEROSOLS=False
+# Angstrom law of the analytic aerosol axis : tau(lambda)=aer*(lambda/AER_LAMBDA0)**(-AER_ANGSTROM)
+AER_LAMBDA0=500.   # reference wavelength in nm, same as aerosol_set_tau_at_wvl in libradtran
+AER_ANGSTROM=1.3   # Angstrom exponent
+
+# lattice of SpectractorSimNight : the airmasses and pressures of the exposures
+# of a night are rounded to these steps, one atmospheric grid per lattice node
+AIRMASS_STEP=0.02
+PRESSURE_STEP=1.   # hPa
+# atmosphere used to estimate the error of the rounding (pwv,ozone,aerosols)
+NIGHT_REFERENCE_ATMOSPHERE=(4.,300.,0.05)
+NIGHT_GRIDDIR='atmgrids'
+NIGHT_PLAN='night_plan.csv'
+
+# load the atmsim files of previous runs instead of recomputing them, when
+# they hold the same grid (see AtmosphereGrid.compare_file)
+FLAG_REUSE_GRIDS=True
+
+# checkpoints of AtmosphereGrid.compute : the transmissions already simulated are
+# saved every CHECKPOINT_INTERVAL points next to the atmsim file, and a compute
+# interrupted by a crash or a wall-time limit resumes from them
+FLAG_CHECKPOINT=True
+CHECKPOINT_INTERVAL=50
+CHECKPOINT_SUFFIX='.checkpoint.npz'
+
+# also write the grids of the atmsim and spectrasim files in a .npy file next to them,
+# opened memory-mapped in native byte order by OpenGridFile
+FLAG_NPY_SIDECAR=False
+SIDECAR_SUFFIX='.npy'
+
+# HDF5 atmospheric grid files : AtmosphereGrid.savefile and loadfile use them for
+# these extensions, one group per grid (see WriteGridHDF5), default group HDF5_GROUP
+HDF5_SUFFIXES=('.h5','.hdf5')
+HDF5_GROUP='atmgrid'
+HDF5_COMPRESSION='gzip'
+
+# files of the plans written by AtmosphereGrid.plan
+PLAN_BASENAME='atmpoint_%04d'
+PLAN_MANIFEST='manifest.csv'
+PLAN_SCRIPT="""#!/bin/sh
+# run the uvspec simulations listed in uvspec_tasks.txt
+# usage : run_uvspec.sh [task]
+#   task : line of uvspec_tasks.txt to run, from 1 to the number of lines
+#          (e.g. $SLURM_ARRAY_TASK_ID or $PBS_ARRAYID), all lines are run without task
+cd "$(dirname "$0")" || exit 1
+UVSPEC=${UVSPEC:-%s}
+if [ $# -ge 1 ]; then
+    set -- $(sed -n "${1}p" uvspec_tasks.txt)
+    "$UVSPEC" < "$1" > "$2"
+else
+    while read inp out; do
+        "$UVSPEC" < "$inp" > "$out" || echo "uvspec failed for $inp" >&2
+    done < uvspec_tasks.txt
+fi
+"""
             
 #----------------------------------------------------------------------------------
 class Atmosphere():
@@ -138,14 +244,17 @@ class Atmosphere():
         airmass (:obj:`float`): airmass of the target
         pressure (:obj:`float`): pressure of the atmosphere 
         temperature (:obj:`float`): temperature of the atmosphere 
+        wlrange (:obj:`tuple`): (min,max) wavelengths simulated by libradtran in nm,
+            the transmission is 0 outside. Default is the full libradtran window.
     """
     
     #---------------------------------------------------------------------------
-    def __init__(self,airmass,pressure,temperature):
+    def __init__(self,airmass,pressure,temperature,wlrange=None):
         self.my_logger = parameters.set_logger(self.__class__.__name__)
         self.airmass = airmass
         self.pressure = pressure
         self.temperature = temperature
+        self.wlrange = wlrange
         self.transmission = lambda x: np.ones_like(x).astype(float)
 
     #---------------------------------------------------------------------------        
@@ -155,18 +264,32 @@ class Atmosphere():
             pwv (:obj:`float`): pressure water vapor
             ozone (:obj:`float`): ozone quantity
             aerosols (:obj:`float`): VAOD Vertical Aerosols Optical Depth
+        Returns:
+            the transmission as a function of the wavelength in nm
+        """
+        wl,atm = self.simulate_sampled(pwv,ozone,aerosols)
+        self.transmission = interp1d(wl,atm,kind='linear',bounds_error=False,fill_value=0.)   
+                    
+        return self.transmission
+    #---------------------------------------------------------------------------        
+    def simulate_sampled(self,pwv,ozone,aerosols):
+        """
+        simulate_sampled(pwv,ozone,aerosols): same as simulate, without building the
+            transmission function : for grids resampled at once by LinearResampler
+        Returns:
+            the wavelengths in nm and the transmission sampled by libradtran
         """
         # first determine the length
         if parameters.VERBOSE :
             self.my_logger.info('\n\tAtmospheric simulation with z=%4.2f, P=%4.2f, T=%4.2f, PWV=%4.2f, OZ=%4.2f, VAOD=%4.2f ' % (self.airmass,self.pressure,self.temperature,pwv,ozone,aerosols))
                  
-        path,thefile = atmsim.ProcessSimulationaer(self.airmass,pwv,ozone,aerosols,self.pressure)
-        data = np.loadtxt(os.path.join(path,thefile))
-        wl = data[:,0]
-        atm = data[:,1]
-        self.transmission = interp1d(wl,atm,kind='linear')   
-                    
-        return self.transmission
+        if FLAG_MOLECULAR_SYNTHESIS:
+            wl,atm = atmsim.GetSynthesizedTransmissionaer(self.airmass,pwv,ozone,aerosols,self.pressure,self.wlrange)
+        elif FLAG_AIRMASS_SCALING:
+            wl,atm = atmsim.GetScaledTransmissionaer(self.airmass,pwv,ozone,aerosols,self.pressure,self.wlrange)
+        else:
+            wl,atm = atmsim.GetTransmissionaer(self.airmass,pwv,ozone,aerosols,self.pressure,self.wlrange)
+        return wl,atm
     #---------------------------------------------------------------------------  
     def plot_transmission(self):
         plt.figure()
@@ -177,6 +300,98 @@ class Atmosphere():
         plt.legend()
         plt.show()
         
+#----------------------------------------------------------------------------------
+class TransmissionTable():
+    """
+    TransmissionTable(): 
+        table of atmospheric transmissions written by atmsim.BuildTransmissionTable,
+        interpolated in airmass, pwv, ozone, aerosols and pressure
+    Args:
+        filename (:obj:`str`): FITS file of the table
+        method (:obj:`str`): interpolation method of RegularGridInterpolator ('linear' is multilinear)
+    """
+    
+    #---------------------------------------------------------------------------
+    def __init__(self,filename,method='linear'):
+        self.my_logger = parameters.set_logger(self.__class__.__name__)
+        self.filename=filename
+        hdu=fits.open(filename)
+        self.header=hdu[0].header
+        # kept in the dtype of the file (float32), RegularGridInterpolator computes in float64
+        table=hdu[0].data
+        self.axes=[np.asarray(hdu[name].data,dtype=float) for name in atmsim.TABLE_AXES]
+        self.wl=np.asarray(hdu['WAVELENGTH'].data,dtype=float)
+        hdu.close()
+        # axes with a single value are not interpolated
+        self.interpolated=[idx for idx,axis in enumerate(self.axes) if len(axis)>1]
+        table=table.reshape([len(self.axes[idx]) for idx in self.interpolated]+[len(self.wl)])
+        self.interpolator=RegularGridInterpolator([self.axes[idx] for idx in self.interpolated],table,method=method)
+        if parameters.VERBOSE or parameters.DEBUG:
+            self.my_logger.info('\n\tTransmissionTable.load table-file=%s' % (filename))
+    #---------------------------------------------------------------------------        
+    def interpolate(self,airmass,pwv,ozone,aerosols,pressure):
+        """
+        Args:
+            parameters of the atmosphere, clipped to the range of the table with a warning
+            (the axes with a single value are not interpolated)
+        Returns:
+            the wavelengths and the interpolated transmission
+        """
+        values=[airmass,pwv,ozone,aerosols,pressure]
+        outside=['%s=%g not in [%g,%g]' % (name,value,axis[0],axis[-1]) for name,value,axis in zip(atmsim.TABLE_AXES,values,self.axes)
+                 if (value<axis[0] or value>axis[-1]) and not np.isclose(value,np.clip(value,axis[0],axis[-1]))]
+        if len(outside)>0:
+            self.my_logger.warning('\n\tTransmissionTable.interpolate : parameters clipped to the table %s : %s' % (self.filename,', '.join(outside)))
+        point=[np.clip(values[idx],self.axes[idx][0],self.axes[idx][-1]) for idx in self.interpolated]
+        if len(point)==0:
+            return self.wl,np.array(self.interpolator.values,dtype=float)
+        return self.wl,self.interpolator([point])[0]
+        
+#----------------------------------------------------------------------------------
+def GetTransmissionTable(filename):
+    """
+    GetTransmissionTable(filename): the TransmissionTable of filename, loaded once per process
+    """
+    if filename not in TransmissionTables:
+        TransmissionTables[filename]=TransmissionTable(filename)
+    return TransmissionTables[filename]
+
+TransmissionTables=dict()
+
+#----------------------------------------------------------------------------------
+class TableAtmosphere(Atmosphere):
+    """
+    TableAtmosphere(): 
+        class to simulate an atmospheric transmission by interpolation in a
+        TransmissionTable, libradtran is not needed
+    Args:
+        airmass (:obj:`float`): airmass of the target
+        pressure (:obj:`float`): pressure of the atmosphere 
+        temperature (:obj:`float`): temperature of the atmosphere 
+        tablefile (:obj:`str`): FITS file of the table, default is TRANSMISSION_TABLE
+    """
+    
+    #---------------------------------------------------------------------------
+    def __init__(self,airmass,pressure,temperature,tablefile=None):
+        Atmosphere.__init__(self,airmass,pressure,temperature)
+        self.my_logger = parameters.set_logger(self.__class__.__name__)
+        if tablefile is None:
+            tablefile=TRANSMISSION_TABLE
+        self.table=GetTransmissionTable(tablefile)
+    #---------------------------------------------------------------------------        
+    def simulate(self,pwv,ozone,aerosols):
+        """
+        Args:
+            pwv (:obj:`float`): pressure water vapor
+            ozone (:obj:`float`): ozone quantity
+            aerosols (:obj:`float`): VAOD Vertical Aerosols Optical Depth
+        """
+        if parameters.VERBOSE :
+            self.my_logger.info('\n\tAtmospheric interpolation with z=%4.2f, P=%4.2f, T=%4.2f, PWV=%4.2f, OZ=%4.2f, VAOD=%4.2f ' % (self.airmass,self.pressure,self.temperature,pwv,ozone,aerosols))
+        wl,atm = self.table.interpolate(self.airmass,pwv,ozone,aerosols,self.pressure)
+        self.transmission = interp1d(wl,atm,kind='linear',bounds_error=False,fill_value=0.)   
+        return self.transmission
+        
 #----------------------------------------------------------------------------------
 class AtmosphereGrid(Atmosphere):
     """
@@ -187,38 +402,297 @@ class AtmosphereGrid(Atmosphere):
         pressure (:obj:`float`): pressure of the atmosphere 
         temperature (:obj:`float`): temperature of the atmosphere 
         filenamedata (:obj:`strt`): XXXXXXXXXX     
+        wlrange (:obj:`tuple`): (min,max) wavelengths simulated by libradtran in nm
     """
     
     #---------------------------------------------------------------------------
-    def __init__(self,airmass,pressure,temperature,filenamedata):
-        Atmosphere.__init__(self,airmass,pressure,temperature)
+    def __init__(self,airmass,pressure,temperature,filenamedata,wlrange=None):
+        Atmosphere.__init__(self,airmass,pressure,temperature,wlrange)
         self.my_logger = parameters.set_logger(self.__class__.__name__)
         self.filenamedata=filenamedata          
         # create the numpy array that will contains the atmospheric grid    
-        self.atmgrid=np.zeros((NB_ATM_POINTS+1,NB_atm_HEADER+NB_atm_DATA))
+        self.atmgrid=np.zeros((NB_ATM_POINTS+1,NB_atm_HEADER+NB_atm_DATA),dtype=GRID_DTYPE)
         self.atmgrid[0,index_atm_data:]=WL
         self.header=fits.Header()
+        self.aerosol_model=('libradtran',)
+        # (aerosols,pwv,ozone,error) of the points where libradtran failed
+        self.failed_points=[]
     #---------------------------------------------------------------------------        
-    def compute(self):
-        # first determine the length
-        if parameters.VERBOSE or parameters.DEBUG:
-            self.my_logger.info('\n\tAtmosphere simulations for z=%4.2f, P=%4.2f, T=%4.2f, for data-file=%s ' % (self.airmass,self.pressure,self.temperature,self.filenamedata))
-            
-        count=0
+    def fill_parameters(self):
+        """
+        fill_parameters(): fills the count and parameter columns of atmgrid
+        Returns:
+            the list of the (aerosols,pwv,ozone) grid points, in the order of the rows
+        """
+        points=[]
         for  aer in AER_Points:
             for pwv in PWV_Points:
                 for oz in OZ_Points:
-                    count+=1
+                    points.append((aer,pwv,oz))
+                    count=len(points)
                     # fills headers info in the numpy array
                     self.atmgrid[count,index_atm_count]=count
                     self.atmgrid[count,index_atm_aer]=aer
                     self.atmgrid[count,index_atm_pwv]=pwv
                     self.atmgrid[count,index_atm_oz]=oz
-                    transmission = self.simulate(pwv,oz,aer)
-                    transm=transmission(WL)   
-                    self.atmgrid[count,index_atm_data:]=transm    # each of atmospheric transmission
+        return points
+    #---------------------------------------------------------------------------        
+    def compute(self,nworkers=None,analytic_aerosols=None,lambda0=None,alpha0=None,checkpoint=None):
+        """
+        Args:
+            nworkers (:obj:`int`): number of libradtran processes run concurrently,
+                default is NB_WORKERS. With nworkers>1 the grid points are dispatched
+                to a process pool, the rows of atmgrid are filled in the same order
+                as in the serial loop.
+            analytic_aerosols (:obj:`bool`): if True libradtran is run only without aerosols
+                and the aerosol axis is applied with the Angstrom law (atmsim.ApplyAerosols),
+                default is FLAG_ANALYTIC_AEROSOLS
+            lambda0 (:obj:`float`): reference wavelength in nm of the aerosol optical depth
+                for analytic_aerosols, default is AER_LAMBDA0
+            alpha0 (:obj:`float`): Angstrom exponent for analytic_aerosols, default is AER_ANGSTROM
+            checkpoint (:obj:`str`): checkpoint file, see simulate_points_checkpointed
+        The points where libradtran fails after its retries are listed in failed_points,
+        their transmission is NaN and the grid computation goes on.
+        """
+        if nworkers is None:
+            nworkers=NB_WORKERS
+        if analytic_aerosols is None:
+            analytic_aerosols=FLAG_ANALYTIC_AEROSOLS
+        if lambda0 is None:
+            lambda0=AER_LAMBDA0
+        if alpha0 is None:
+            alpha0=AER_ANGSTROM
+        # first determine the length
+        if parameters.VERBOSE or parameters.DEBUG:
+            self.my_logger.info('\n\tAtmosphere simulations for z=%4.2f, P=%4.2f, T=%4.2f, for data-file=%s, nworkers=%d ' % (self.airmass,self.pressure,self.temperature,self.filenamedata,nworkers))
+            
+        points=self.fill_parameters()
+        self.failed_points=[]
+        
+        if analytic_aerosols:
+            self.aerosol_model=('angstrom',lambda0,alpha0)
+            # simulate the atmospheres without aerosols only once
+            pwv_oz_points=[(pwv,oz) for pwv in PWV_Points for oz in OZ_Points]
+            all_transm=self.simulate_all_points([(0.,pwv,oz) for pwv,oz in pwv_oz_points],nworkers,checkpoint)
+            noaer_transm=dict(zip(pwv_oz_points,all_transm))
+            for count,(aer,pwv,oz) in enumerate(points,1):
+                if noaer_transm[(pwv,oz)] is None:
+                    self.atmgrid[count,index_atm_data:]=np.nan
+                    continue
+                # slant aerosol optical depth
+                transm=atmsim.ApplyAerosols(WL,noaer_transm[(pwv,oz)],lambda0,aer*self.airmass,alpha0)
+                self.atmgrid[count,index_atm_data:]=transm    # each of atmospheric transmission
+        else:
+            self.aerosol_model=('libradtran',)
+            all_transm=self.simulate_all_points(points,nworkers,checkpoint)
+            for count,transm in enumerate(all_transm,1):
+                if transm is None:
+                    self.atmgrid[count,index_atm_data:]=np.nan
+                    continue
+                self.atmgrid[count,index_atm_data:]=transm    # each of atmospheric transmission
+        
+        if len(self.failed_points)>0:
+            self.my_logger.warning('\n\tAtmosphereGrid.compute : libradtran failed or was rejected for %d points (aer,pwv,oz) : %s' \
+                                   % (len(self.failed_points),' '.join(['(%g,%g,%g)' % point[:3] for point in self.failed_points])))
                     
         return self.atmgrid
+    #---------------------------------------------------------------------------        
+    def simulate_points(self,points,nworkers=1):
+        """
+        simulate_points(points,nworkers): simulate the atmospheric transmissions of a list of points
+        Args:
+            points (:obj:`list`): list of (aerosols,pwv,ozone)
+            nworkers (:obj:`int`): number of libradtran processes run concurrently
+        Returns:
+            the list of the transmissions sampled on WL, in the order of points,
+            None for the points where libradtran failed or its output was rejected,
+            added to failed_points
+        """
+        if nworkers>1:
+            args=[(self.airmass,self.pressure,self.temperature,self.wlrange,pwv,oz,aer) for aer,pwv,oz in points]
+            pool=multiprocessing.Pool(processes=nworkers,initializer=_init_grid_worker,initargs=(GridWorkerSettings(),))
+            try:
+                # map keeps the order of the points, one point per task
+                results=[]
+                for result,records in pool.map(_simulate_grid_point,args,chunksize=1):
+                    # the uvspec runs of the workers go to the run log of this process
+                    UVspec.merge_run_log(records)
+                    results.append(result)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results=[]
+            for aer,pwv,oz in points:
+                try:
+                    results.append((self.simulate_sampled(pwv,oz,aer),None))
+                except UVspec.UVspecError as error:
+                    # also UVspecOutputError : output rejected by the checks of atmsim (wavelength chunks,
+                    # optical depths), any other exception is a bug and is raised
+                    results.append((None,str(error)))
+        sampled=[]
+        for (aer,pwv,oz),(transm,error) in zip(points,results):
+            if error is not None:
+                self.failed_points.append((aer,pwv,oz,error))
+            sampled.append(transm)
+        return ResampleTransmissions(sampled,WL)
+    #---------------------------------------------------------------------------        
+    def simulate_all_points(self,points,nworkers=1,checkpoint=None):
+        """
+        simulate_all_points(points,nworkers,checkpoint): simulate_points, or
+            simulate_points_checkpointed when a checkpoint file is given
+        """
+        if checkpoint is None:
+            return self.simulate_points(points,nworkers)
+        return self.simulate_points_checkpointed(points,nworkers,checkpoint)
+    #---------------------------------------------------------------------------        
+    def checkpoint_setup(self):
+        """
+        checkpoint_setup(): description of the simulations, the transmissions of a
+            checkpoint are only reused by a grid with the same description
+        """
+        wlrange=None
+        if self.wlrange is not None:
+            wlrange=(float(self.wlrange[0]),float(self.wlrange[1]))
+        return 'z=%r P=%r T=%r wl=%r mode=%s aerosols=%s version=%s config=%s' % (float(self.airmass),float(self.pressure),float(self.temperature),
+                                                                                 wlrange,SimulationMode(),self.aerosol_model[0],
+                                                                                 atmsim.GetLibRadtranVersion(),atmsim.GetConfigurationHash())
+    #---------------------------------------------------------------------------        
+    def simulate_points_checkpointed(self,points,nworkers,checkpoint):
+        """
+        simulate_points_checkpointed(points,nworkers,checkpoint): same as simulate_points, but
+            the points are simulated by batches of CHECKPOINT_INTERVAL points and the
+            transmissions done so far are saved in the checkpoint file after each batch.
+            The points already done in an existing checkpoint file for the same grid are
+            not simulated again : an interrupted compute resumes where it stopped.
+            The points where libradtran failed are not saved, they are tried again.
+        Args:
+            points (:obj:`list`): list of (aerosols,pwv,ozone)
+            nworkers (:obj:`int`): number of libradtran processes run concurrently
+            checkpoint (:obj:`str`): the checkpoint file (.npz)
+        Returns:
+            the list of the transmissions sampled on WL, None where libradtran failed
+        """
+        setup=self.checkpoint_setup()
+        points=np.array(points,dtype=float)
+        transm=np.zeros((len(points),len(WL)),dtype=self.atmgrid.dtype)
+        done=np.zeros(len(points),dtype=bool)
+        if os.path.isfile(checkpoint):
+            try:
+                saved=np.load(checkpoint)
+                if str(saved['setup'])==setup and np.array_equal(saved['points'],points) and np.array_equal(saved['wl'],WL):
+                    transm[...]=saved['transm']
+                    done[...]=saved['done']
+                    self.my_logger.info('\n\tAtmosphereGrid.compute resumes from %s : %d of %d points done' % (checkpoint,done.sum(),len(points)))
+                else:
+                    self.my_logger.warning('\n\tAtmosphereGrid.compute ignores %s, made for another grid' % checkpoint)
+                saved.close()
+            except (IOError,OSError,ValueError,KeyError) as error:
+                self.my_logger.warning('\n\tAtmosphereGrid.compute ignores unreadable %s : %s' % (checkpoint,error))
+        
+        todo=np.flatnonzero(~done)
+        # the batches keep all the workers busy
+        batchsize=max(CHECKPOINT_INTERVAL,nworkers)
+        for start in range(0,len(todo),batchsize):
+            batch=todo[start:start+batchsize]
+            batch_transm=self.simulate_points([tuple(points[index]) for index in batch],nworkers)
+            for index,row in zip(batch,batch_transm):
+                if row is not None:
+                    transm[index]=row
+                    done[index]=True
+            WriteCheckpoint(checkpoint,setup=np.array(setup),points=points,wl=WL,transm=transm,done=done)
+        return [transm[index] if done[index] else None for index in range(len(points))]
+    #---------------------------------------------------------------------------        
+    def append_points(self,points,filename,group=None,nworkers=None):
+        """
+        append_points(points,filename,group,nworkers): simulate new grid points and append
+            them to atmgrid and to the grid of an HDF5 file (see AppendGridHDF5), e.g. to
+            extend the range of an axis without computing the grid again
+        Args:
+            points (:obj:`list`): list of (aerosols,pwv,ozone)
+            filename (:obj:`str`): the HDF5 file, holding the grid of this airmass and pressure
+            group (:obj:`str`): the group of the grid, default is HDF5_GROUP
+            nworkers (:obj:`int`): number of libradtran processes run concurrently
+        Returns:
+            the rows appended
+        """
+        if nworkers is None:
+            nworkers=NB_WORKERS
+        rows=np.zeros((len(points),self.atmgrid.shape[1]),dtype=self.atmgrid.dtype)
+        rows[:,index_atm_count]=self.atmgrid.shape[0]+np.arange(len(points))
+        rows[:,index_atm_aer:index_atm_data]=points
+        for row,transm in zip(rows,self.simulate_points(points,nworkers)):
+            if transm is None:
+                row[index_atm_data:]=np.nan
+            else:
+                row[index_atm_data:]=transm
+        AppendGridHDF5(filename,rows,group)
+        self.atmgrid=np.vstack((self.atmgrid,rows))
+        return rows
+    #---------------------------------------------------------------------------        
+    def plan(self,plandir):
+        """
+        plan(plandir): writes the libradtran input files of all the grid points
+            in plandir, without running uvspec. Also writes:
+            - manifest.csv : one row per grid point with its parameters, input and output files
+            - uvspec_tasks.txt : the input and output files, one line per grid point
+            - run_uvspec.sh : runs the task given as argument (e.g. an array job index,
+              from 1 to NB_ATM_POINTS) or all the tasks when no argument is given
+            The outputs are then read back by ingest(plandir).
+        Args:
+            plandir (:obj:`str`): directory of the plan, file paths are relative to it
+        Returns:
+            the manifest as a pandas DataFrame
+        """
+        ensure_dir(plandir)
+        points=self.fill_parameters()
+        rows=[]
+        for count,(aer,pwv,oz) in enumerate(points,1):
+            inp,out=atmsim.PlanSimulationaer(self.airmass,pwv,oz,aer,self.pressure,topdir=plandir,basename=PLAN_BASENAME % count,wlrange=self.wlrange)
+            rows.append((count,aer,pwv,oz,self.airmass,self.pressure,os.path.relpath(inp,plandir),os.path.relpath(out,plandir)))
+        manifest=pd.DataFrame(rows,columns=['count','aer','pwv','oz','airmass','pressure','input','output'])
+        manifest.to_csv(os.path.join(plandir,PLAN_MANIFEST),index=False)
+        
+        f=open(os.path.join(plandir,'uvspec_tasks.txt'),'w')
+        for inp,out in zip(manifest['input'],manifest['output']):
+            f.write(inp+' '+out+'\n')
+        f.close()
+        
+        scriptname=os.path.join(plandir,'run_uvspec.sh')
+        f=open(scriptname,'w')
+        f.write(PLAN_SCRIPT % UVspec.UVspec().command(atmsim.libradtranpath))
+        f.close()
+        os.chmod(scriptname,0o755)
+        
+        if parameters.VERBOSE or parameters.DEBUG:
+            self.my_logger.info('\n\tAtmosphereGrid.plan %d simulations in %s' % (len(points),plandir))
+        return manifest
+    #---------------------------------------------------------------------------        
+    def ingest(self,plandir):
+        """
+        ingest(plandir): fills atmgrid with the uvspec outputs of a plan written by plan(plandir).
+            The manifest must describe the current grid, and each output is validated.
+        Args:
+            plandir (:obj:`str`): directory of the plan
+        Returns:
+            the atmospheric grid
+        """
+        manifest=pd.read_csv(os.path.join(plandir,PLAN_MANIFEST))
+        points=self.fill_parameters()
+        if len(manifest)!=len(points):
+            raise ValueError('plan %s has %d points, the grid has %d points' % (plandir,len(manifest),len(points)))
+        if not np.allclose(manifest['airmass'],self.airmass) or not np.allclose(manifest['pressure'],self.pressure):
+            raise ValueError('plan %s was made for another airmass or pressure' % plandir)
+        if not np.allclose(manifest[['aer','pwv','oz']].values,np.array(points)):
+            raise ValueError('plan %s was made for another atmospheric grid' % plandir)
+        
+        sampled=[atmsim.IngestSimulationaer(os.path.join(plandir,out)) for out in manifest['output']]
+        for count,transm in zip(manifest['count'],ResampleTransmissions(sampled,WL)):
+            self.atmgrid[count,index_atm_data:]=transm
+            
+        if parameters.VERBOSE or parameters.DEBUG:
+            self.my_logger.info('\n\tAtmosphereGrid.ingest %d simulations from %s' % (len(manifest),plandir))
+        return self.atmgrid
     #---------------------------------------------------------------------------  
     def plot_transmission(self):
         plt.figure()
@@ -242,7 +716,13 @@ class AtmosphereGrid(Atmosphere):
         cbar.set_label('Atmospheric transmission')
         plt.show()
     #---------------------------------------------------------------------------    
-    def savefile(self,filename=""):
+    def savefile(self,filename="",group=None):
+        """
+        savefile(filename,group): saves the grid in a FITS file, or in the group of
+            an HDF5 file for the HDF5_SUFFIXES extensions (see WriteGridHDF5)
+        Returns:
+            the header of the file
+        """
              
         hdr = fits.Header()
                
@@ -255,7 +735,9 @@ class AtmosphereGrid(Atmosphere):
             return
         else:
             hdr['ATMSIM'] = "libradtran"
-            hdr['SIMVERS'] = "2.0.1"
+            hdr['SIMVERS'] = atmsim.GetLibRadtranVersion()
+            hdr['SIMHASH'] = atmsim.GetConfigurationHash()
+            hdr['ATMMODE'] = SimulationMode()
             hdr['DATAFILE']=self.filenamedata
             hdr['SIMUFILE']=os.path.basename(self.filename)
             
@@ -263,6 +745,7 @@ class AtmosphereGrid(Atmosphere):
             hdr['PRESSURE'] = self.pressure
             hdr['TEMPERAT'] = self.temperature
             hdr['NBATMPTS'] = NB_ATM_POINTS
+            hdr['NBFAILED'] = len(self.failed_points)
         
             hdr['NBAERPTS'] = NB_AER_POINTS
             hdr['AERMIN'] = AER_MIN
@@ -276,12 +759,20 @@ class AtmosphereGrid(Atmosphere):
             hdr['OZMIN'] = OZ_MIN
             hdr['OZMAX'] = OZ_MAX
 
+            hdr['AERMODEL'] = self.aerosol_model[0]
+            if self.aerosol_model[0]=='angstrom':
+                hdr['AERLBDA0'] = self.aerosol_model[1]
+                hdr['AERALPHA'] = self.aerosol_model[2]
+
             hdr['AER_PTS'] =np.array_str(AER_Points)
             hdr['PWV_PTS'] =np.array_str(PWV_Points)
             hdr['OZ_PTS'] =np.array_str(OZ_Points)
             hdr['NBWLBIN'] = WL.size
             hdr['WLMIN'] = WLMIN
             hdr['WLMAX'] = WLMAX
+            if self.wlrange is not None:
+                hdr['WLSIMMIN'] = self.wlrange[0]
+                hdr['WLSIMMAX'] = self.wlrange[1]
     
             hdr['IDX_CNT']=index_atm_count
             hdr['IDX_AER']=index_atm_aer
@@ -290,16 +781,88 @@ class AtmosphereGrid(Atmosphere):
             hdr['IDX_DATA']=index_atm_data
     
             if parameters.VERBOSE:
-                print hdr
+                print(hdr)
     
-            hdu = fits.PrimaryHDU(self.atmgrid,header=hdr)
-            hdu.writeto(self.filename,overwrite=True)
+            if IsHDF5File(self.filename):
+                WriteGridHDF5(self.filename,self.atmgrid,hdr,group)
+            else:
+                hdu = fits.PrimaryHDU(self.atmgrid,header=hdr)
+                hdu.writeto(self.filename,overwrite=True)
+                if FLAG_NPY_SIDECAR:
+                    WriteSidecar(self.filename,self.atmgrid)
             if parameters.VERBOSE or parameters.DEBUG:
                 self.my_logger.info('\n\tAtmosphere.save atm-file=%s' % (self.filename))
                 
             return hdr
     #---------------------------------------------------------------------------   
-    def loadfile(self,filename):
+    def compare_file(self,filename,group=None):
+        """
+        compare_file(filename): compares an atmsim file with the grid that compute would
+            produce : airmass, pressure, parameter axes and grid points, wavelengths, libradtran version
+            and model configuration (SIMHASH, see atmsim.GetConfigurationHash), simulation mode and
+            aerosol model (FLAG_ANALYTIC_AEROSOLS). A file with failed points never matches.
+        Args:
+            filename (:obj:`str`): the atmsim file
+            group (:obj:`str`): the group of the grid in an HDF5 file
+        Returns:
+            the list of the differences, empty when the file can be loaded instead of computed
+        """
+        try:
+            if IsHDF5File(filename):
+                data,hdr=ReadGridHDF5(filename,group)
+            else:
+                data,hdr=OpenGridFile(filename)
+        except (IOError,OSError,ValueError,TypeError,KeyError,ImportError) as error:
+            return ['unreadable file (%s)' % error]
+        
+        differences=[]
+        expected=[('SIMVERS',atmsim.GetLibRadtranVersion()),('SIMHASH',atmsim.GetConfigurationHash()),('ATMMODE',SimulationMode()),
+                  ('AERMODEL','angstrom' if FLAG_ANALYTIC_AEROSOLS else 'libradtran'),('NBFAILED',0),('IDX_DATA',index_atm_data),
+                  ('NBATMPTS',NB_ATM_POINTS),('NBAERPTS',NB_AER_POINTS),('NBPWVPTS',NB_PWV_POINTS),('NBOZPTS',NB_OZ_POINTS)]
+        for key,value in expected:
+            if hdr.get(key)!=value:
+                differences.append('%s=%s instead of %s' % (key,hdr.get(key),value))
+        if atmsim.GetLibRadtranVersion()==atmsim.LIBRADTRAN_VERSION_UNKNOWN:
+            differences.append('unknown libradtran version, the file may come from an other one')
+        close=[('AIRMASS',self.airmass),('PRESSURE',self.pressure),
+               ('AERMIN',AER_MIN),('AERMAX',AER_MAX),('PWVMIN',PWV_MIN),('PWVMAX',PWV_MAX),('OZMIN',OZ_MIN),('OZMAX',OZ_MAX)]
+        if FLAG_ANALYTIC_AEROSOLS:
+            close+=[('AERLBDA0',AER_LAMBDA0),('AERALPHA',AER_ANGSTROM)]
+        if self.wlrange is not None:
+            close+=[('WLSIMMIN',self.wlrange[0]),('WLSIMMAX',self.wlrange[1])]
+        elif 'WLSIMMIN' in hdr:
+            differences.append('simulated wavelengths restricted to %s-%s nm' % (hdr['WLSIMMIN'],hdr['WLSIMMAX']))
+        for key,value in close:
+            if hdr.get(key) is None or not np.isclose(hdr[key],value):
+                differences.append('%s=%s instead of %s' % (key,hdr.get(key),value))
+        
+        if data.dtype.itemsize!=self.atmgrid.dtype.itemsize:
+            differences.append('grid of %d bytes floats instead of %d' % (data.dtype.itemsize,self.atmgrid.dtype.itemsize))
+        if data.shape!=self.atmgrid.shape:
+            differences.append('grid shape %s instead of %s' % (str(data.shape),str(self.atmgrid.shape)))
+        else:
+            if not np.array_equal(data[0,index_atm_data:],WL):
+                differences.append('other wavelengths')
+            # the axes may have the same ends and lengths but other values
+            points=[(aer,pwv,oz) for aer in AER_Points for pwv in PWV_Points for oz in OZ_Points]
+            if not np.allclose(data[1:,index_atm_aer:index_atm_oz+1],points):
+                differences.append('other (aer,pwv,oz) grid points')
+        return differences
+    #---------------------------------------------------------------------------   
+    def loadfile(self,filename,mmap=False,group=None,aer=None,pwv=None,oz=None):
+        """
+        loadfile(filename,mmap,group,aer,pwv,oz): loads an atmsim file, FITS or HDF5
+        Args:
+            filename (:obj:`str`): the atmsim file
+            mmap (:obj:`bool`): if True atmgrid is a read-only memory map of the FITS file
+                (or of its .npy sidecar, see OpenGridFile) : only the rows and wavelengths
+                used are read, in the type of the file. Otherwise atmgrid is of type GRID_DTYPE
+            group (:obj:`str`): the group of the grid in an HDF5 file, default is HDF5_GROUP
+            aer,pwv,oz (:obj:`tuple`): (min,max) ranges of the parameters, only the grid
+                points in these ranges are loaded
+        Returns:
+            the atmospheric grid and the header of the file
+        """
              
         if filename != "" :
             self.filename = filename
@@ -312,60 +875,381 @@ class AtmosphereGrid(Atmosphere):
             return
         else:
         
-            hdu= fits.open(self.filename)
-            hdr=hdu[0].header
+            if IsHDF5File(self.filename):
+                data,hdr=ReadGridHDF5(self.filename,group,aer,pwv,oz)
+            else:
+                data,hdr=OpenGridFile(self.filename,mmap)
+                if aer is not None or pwv is not None or oz is not None:
+                    rows=SelectGridRows(data[1:,hdr['IDX_AER']],data[1:,hdr['IDX_PWV']],data[1:,hdr['IDX_OZ']],aer,pwv,oz)
+                    data=data[np.concatenate(([0],rows+1))]
        
-            #hdr['ATMSIM'] = "libradtran"
-            #hdr['SIMVERS'] = "2.0.1"
             self.filenamedata=hdr['DATAFILE']
-            #hdr['SIMUFILE']=os.path.basename(self.filename)
             
             self.airmass=hdr['AIRMASS'] 
             self.pressure=hdr['PRESSURE']
             self.temperature=hdr['TEMPERAT']
             
-            # hope those are the same parameters : TBD !!!!
-            NB_ATM_POINTS=hdr['NBATMPTS']
-        
-            NB_AER_POINTS=hdr['NBAERPTS'] 
-            AER_MIN=hdr['AERMIN']  
-            AER_MAX=hdr['AERMAX'] 
-
-            NB_PWV_POINTS=hdr['NBPWVPTS'] 
-            PWV_MIN=hdr['PWVMIN'] 
-            PWV_MAX=hdr['PWVMAX'] 
-        
-            NB_OZ_POINTS=hdr['NBOZPTS'] 
-            OZ_MIN=hdr['OZMIN'] 
-            OZ_MAX=hdr['OZMAX'] 
-            
-            AER_Points=np.linspace(AER_MIN,AER_MAX,NB_AER_POINTS)
-            OZ_Points=np.linspace(OZ_MIN,OZ_MAX,NB_OZ_POINTS)
-            PWV_Points=np.linspace(PWV_MIN,PWV_MAX,NB_PWV_POINTS)
-
-            #hdr['AER_PTS'] =np.array_str(AER_Points)
-            #hdr['PWV_PTS'] =np.array_str(PWV_Points)
-            #hdr['OZ_PTS'] =np.array_str(OZ_Points)
-            
-            NBWLBINS= hdr['NBWLBIN']
-            WLMIN= hdr['WLMIN']
-            WLMAX= hdr['WLMAX']
-    
-            index_atm_count=hdr['IDX_CNT']
-            index_atm_aer=hdr['IDX_AER']
-            index_atm_pwv=hdr['IDX_PWV']
-            index_atm_oz=hdr['IDX_OZ']
-            index_atm_data=hdr['IDX_DATA']
-    
-            self.atmgrid=np.zeros((NB_ATM_POINTS+1,NB_atm_HEADER+NB_atm_DATA))
+            # grid definition of the points loaded, which may differ from the module settings
+            self.nb_atm_points=data.shape[0]-1
+            self.aer_points=np.unique(data[1:,hdr['IDX_AER']])
+            self.pwv_points=np.unique(data[1:,hdr['IDX_PWV']])
+            self.oz_points=np.unique(data[1:,hdr['IDX_OZ']])
+            self.index_atm_data=hdr['IDX_DATA']
+            if 'AERMODEL' in hdr:
+                if hdr['AERMODEL']=='angstrom':
+                    self.aerosol_model=('angstrom',hdr['AERLBDA0'],hdr['AERALPHA'])
+                else:
+                    self.aerosol_model=(hdr['AERMODEL'],)
+            if 'WLSIMMIN' in hdr:
+                self.wlrange=(hdr['WLSIMMIN'],hdr['WLSIMMAX'])
     
-            self.atmgrid[:,:]=hdu[0].data[:,:]
+            if mmap:
+                self.atmgrid=data
+            else:
+                self.atmgrid=np.array(data,dtype=GRID_DTYPE)
+            self.header=hdr
            
             if parameters.VERBOSE or parameters.DEBUG:
                 self.my_logger.info('\n\tAtmosphere.load atm-file=%s' % (self.filename))
                 
             return self.atmgrid,self.header
         #---------------------------------------------------------------------------
+
+
+#----------------------------------------------------------------------------------
+def SimulationMode():
+    """
+    SimulationMode(): how the transmissions are simulated with the current flags,
+        written in the atmsim files (ATMMODE)
+    """
+    if FLAG_MOLECULAR_SYNTHESIS:
+        mode='synthesis'
+    elif FLAG_AIRMASS_SCALING:
+        mode='airmass_scaling'
+    else:
+        mode='direct'
+    if atmsim.FLAG_FASTDIRECT:
+        mode+='+fastdirect'
+        if atmsim.FLAG_FASTDIRECT_NOSOURCE:
+            mode+='+nosource'
+    return mode
+
+#----------------------------------------------------------------------------------
+def WriteCheckpoint(filename,**arrays):
+    """
+    WriteCheckpoint(filename,**arrays): saves the arrays in the npz file filename.
+        The arrays are written in a temporary file renamed to filename at the end :
+        an interruption while writing leaves the previous checkpoint intact.
+    """
+    tmpfilename=filename+'.tmp'
+    f=open(tmpfilename,'wb')
+    try:
+        np.savez(f,**arrays)
+    finally:
+        f.close()
+    os.rename(tmpfilename,filename)
+
+#----------------------------------------------------------------------------------
+def WriteSidecar(filename,grid):
+    """
+    WriteSidecar(filename,grid): saves grid in the .npy sidecar of the FITS file filename
+    """
+    np.save(filename+SIDECAR_SUFFIX,np.ascontiguousarray(grid))
+
+#----------------------------------------------------------------------------------
+def OpenGridFile(filename,mmap=True):
+    """
+    OpenGridFile(filename,mmap): opens the grid of an atmsim or spectrasim file.
+        With mmap, the grid is memory-mapped : slicing some rows or wavelengths
+        only reads these from the disk. It is mapped from the .npy sidecar of the file
+        (see FLAG_NPY_SIDECAR) when this one is up to date, in native byte order,
+        otherwise from the FITS file itself.
+    Args:
+        filename (:obj:`str`): the FITS file
+        mmap (:obj:`bool`): memory-map the grid, otherwise it is read in memory
+    Returns:
+        the grid (read-only when memory-mapped) and the header of the FITS file
+    """
+    sidecar=filename+SIDECAR_SUFFIX
+    if mmap and os.path.isfile(sidecar) and os.path.getmtime(sidecar)>=os.path.getmtime(filename):
+        header=fits.getheader(filename)
+        data=np.load(sidecar,mmap_mode='r')
+        if data.shape==(header['NAXIS2'],header['NAXIS1']):
+            return data,header
+    hdu=fits.open(filename,memmap=mmap)
+    header=hdu[0].header
+    data=hdu[0].data
+    if mmap:
+        data.flags.writeable=False
+    else:
+        data=np.array(data)
+    hdu.close()
+    return data,header
+
+#----------------------------------------------------------------------------------
+def SelectGridRows(aer_values,pwv_values,oz_values,aer=None,pwv=None,oz=None):
+    """
+    SelectGridRows(aer_values,pwv_values,oz_values,aer,pwv,oz): selects grid points by parameter ranges
+    Args:
+        aer_values,pwv_values,oz_values (:obj:`array`): parameters of the grid points
+        aer,pwv,oz (:obj:`tuple`): (min,max) ranges of the parameters, None for no selection
+    Returns:
+        the increasing indexes of the points in all the ranges
+    """
+    keep=np.ones(len(aer_values),dtype=bool)
+    for values,valuerange in ((aer_values,aer),(pwv_values,pwv),(oz_values,oz)):
+        if valuerange is not None:
+            # bounds in the type of the values : float32(0.1) is above 0.1
+            lower,upper=np.asarray(valuerange,dtype=np.asarray(values).dtype)
+            keep&=(values>=lower)&(values<=upper)
+    return np.flatnonzero(keep)
+
+#----------------------------------------------------------------------------------
+def IsHDF5File(filename):
+    """
+    IsHDF5File(filename): True for the HDF5 grid files, by their extension (HDF5_SUFFIXES)
+    """
+    return os.path.splitext(filename)[1].lower() in HDF5_SUFFIXES
+
+#----------------------------------------------------------------------------------
+def _open_hdf5(filename,mode):
+    if h5py is None:
+        raise ImportError('h5py is required for the HDF5 grid file %s' % filename)
+    return h5py.File(filename,mode)
+
+#----------------------------------------------------------------------------------
+def _set_hdf5_axes(grp):
+    """
+    _set_hdf5_axes(grp): writes the axes of the grid of the HDF5 group grp and their
+        header cards, from the parameters of its points
+    """
+    for name,key in (('aer','AER'),('pwv','PWV'),('oz','OZ')):
+        axis=np.unique(grp[name][...])
+        if name+'_points' in grp:
+            del grp[name+'_points']
+        grp.create_dataset(name+'_points',data=axis)
+        grp.attrs['NB'+key+'PTS']=len(axis)
+        if len(axis)>0:
+            grp.attrs[key+'MIN']=axis[0]
+            grp.attrs[key+'MAX']=axis[-1]
+        grp.attrs[key+'_PTS']=np.array_str(axis)
+    grp.attrs['NBATMPTS']=grp['transmission'].shape[0]
+
+#----------------------------------------------------------------------------------
+def WriteGridHDF5(filename,grid,header,group=None):
+    """
+    WriteGridHDF5(filename,grid,header,group): writes an atmospheric grid in a group of
+        an HDF5 file, replacing the group if it exists. Many grids, e.g. the exposures
+        of a season, can be stored in the same file. The group holds:
+        - the header cards as attributes
+        - wl : the wavelengths
+        - aer, pwv, oz : the parameters of each grid point
+        - aer_points, pwv_points, oz_points : the axes of the grid
+        - transmission : the transmissions, one row per grid point, compressed in chunks
+          of one slice of the ozone axis (the fastest axis of the grid)
+    Args:
+        filename (:obj:`str`): the HDF5 file, created if needed
+        grid (:obj:`array`): the grid, in the atmgrid layout
+        header (:obj:`fits.Header`): the header of the grid
+        group (:obj:`str`): name of the group, default is HDF5_GROUP
+    """
+    if group is None:
+        group=HDF5_GROUP
+    f=_open_hdf5(filename,'a')
+    try:
+        if group in f:
+            del f[group]
+        grp=f.create_group(group)
+        for key,value in header.items():
+            grp.attrs[key]=value
+        points=grid[1:]
+        grp.create_dataset('wl',data=grid[0,index_atm_data:])
+        for name,index in (('aer',index_atm_aer),('pwv',index_atm_pwv),('oz',index_atm_oz)):
+            grp.create_dataset(name,data=points[:,index],maxshape=(None,))
+        chunkrows=max(1,len(np.unique(points[:,index_atm_oz])))
+        grp.create_dataset('transmission',data=points[:,index_atm_data:],maxshape=(None,points.shape[1]-index_atm_data),
+                           chunks=(chunkrows,points.shape[1]-index_atm_data),compression=HDF5_COMPRESSION,shuffle=True)
+        grp.attrs['NBFAILED']=int(np.isnan(points[:,index_atm_data:]).any(axis=1).sum())
+        _set_hdf5_axes(grp)
+    finally:
+        f.close()
+
+#----------------------------------------------------------------------------------
+def AppendGridHDF5(filename,rows,group=None):
+    """
+    AppendGridHDF5(filename,rows,group): appends grid points to a grid written by WriteGridHDF5,
+        and updates its axes and header cards
+    Args:
+        filename (:obj:`str`): the HDF5 file
+        rows (:obj:`array`): the grid points, in the atmgrid layout, on the wavelengths of the grid
+        group (:obj:`str`): name of the group, default is HDF5_GROUP
+    """
+    if group is None:
+        group=HDF5_GROUP
+    rows=np.atleast_2d(rows)
+    f=_open_hdf5(filename,'a')
+    try:
+        grp=f[group]
+        transmission=grp['transmission']
+        if rows.shape[1]-index_atm_data!=transmission.shape[1]:
+            raise ValueError('grid points of %d wavelengths for the grid %s:%s of %d wavelengths' \
+                             % (rows.shape[1]-index_atm_data,filename,group,transmission.shape[1]))
+        nrows=transmission.shape[0]
+        transmission.resize(nrows+len(rows),axis=0)
+        transmission[nrows:]=rows[:,index_atm_data:]
+        for name,index in (('aer',index_atm_aer),('pwv',index_atm_pwv),('oz',index_atm_oz)):
+            grp[name].resize(nrows+len(rows),axis=0)
+            grp[name][nrows:]=rows[:,index]
+        grp.attrs['NBFAILED']=int(grp.attrs.get('NBFAILED',0))+int(np.isnan(rows[:,index_atm_data:]).any(axis=1).sum())
+        _set_hdf5_axes(grp)
+    finally:
+        f.close()
+
+#----------------------------------------------------------------------------------
+def ReadGridHDF5(filename,group=None,aer=None,pwv=None,oz=None):
+    """
+    ReadGridHDF5(filename,group,aer,pwv,oz): reads a grid written by WriteGridHDF5.
+        Only the chunks of the grid points in the parameter ranges are read.
+    Args:
+        filename (:obj:`str`): the HDF5 file
+        group (:obj:`str`): name of the group, default is HDF5_GROUP
+        aer,pwv,oz (:obj:`tuple`): (min,max) ranges of the parameters, None for no selection
+    Returns:
+        the grid points in the atmgrid layout, and the header of the grid
+    """
+    if group is None:
+        group=HDF5_GROUP
+    f=_open_hdf5(filename,'r')
+    try:
+        grp=f[group]
+        header=fits.Header()
+        for key,value in grp.attrs.items():
+            if isinstance(value,bytes):
+                value=value.decode()
+            elif isinstance(value,np.generic):
+                value=value.item()
+            header[key]=value
+        wl=grp['wl'][...]
+        params=[grp[name][...] for name in ('aer','pwv','oz')]
+        rows=SelectGridRows(params[0],params[1],params[2],aer,pwv,oz)
+        grid=np.zeros((len(rows)+1,index_atm_data+len(wl)),dtype=grp['transmission'].dtype)
+        grid[0,index_atm_data:]=wl
+        grid[1:,index_atm_count]=rows+1
+        for index,values in zip((index_atm_aer,index_atm_pwv,index_atm_oz),params):
+            grid[1:,index]=values[rows]
+        if len(rows)>0 and rows[-1]-rows[0]+1==len(rows):
+            grid[1:,index_atm_data:]=grp['transmission'][rows[0]:rows[-1]+1]
+        elif len(rows)>0:
+            grid[1:,index_atm_data:]=grp['transmission'][rows,:]
+    finally:
+        f.close()
+    return grid,header
+
+#----------------------------------------------------------------------------------
+def GridWorkerSettings():
+    """
+    GridWorkerSettings(): the current values of GRID_WORKER_SETTINGS and ATMSIM_WORKER_SETTINGS
+    Returns:
+        the dictionaries of the settings of spectractorsim and of atmsim
+    """
+    gridsettings=dict((name,globals()[name]) for name in GRID_WORKER_SETTINGS)
+    atmsimsettings=dict((name,getattr(atmsim,name)) for name in ATMSIM_WORKER_SETTINGS)
+    return gridsettings,atmsimsettings
+
+#----------------------------------------------------------------------------------
+def _init_grid_worker(settings=None):
+    """
+    _init_grid_worker(settings): initializer of the AtmosphereGrid.compute process pool.
+        The worker takes the settings of the parent process (GridWorkerSettings), whatever
+        the start method of the pool. Each worker writes its libradtran files in its own
+        workspace (atmsim.GetWorkspace), removed when the worker exits : pool workers leave
+        without running atexit.
+    """
+    if settings is not None:
+        gridsettings,atmsimsettings=settings
+        globals().update(gridsettings)
+        for name,value in atmsimsettings.items():
+            setattr(atmsim,name,value)
+    # the records of the uvspec runs are returned to the parent, which writes them
+    UVspec.set_run_log_sink(None)
+    multiprocessing.util.Finalize(None,atmsim.CleanSimDir,exitpriority=0)
+
+#----------------------------------------------------------------------------------
+def _simulate_grid_point(args):
+    """
+    _simulate_grid_point(args): simulate one point of the atmospheric grid in a worker
+    Args:
+        args (:obj:`tuple`): (airmass,pressure,temperature,wlrange,pwv,ozone,aerosols)
+    Returns:
+        ((wl,transmission) sampled by libradtran,None), or (None,error message) if libradtran failed
+        or its output was rejected, and the records of the uvspec runs (UVspec.run_log)
+    """
+    airmass,pressure,temperature,wlrange,pwv,oz,aer=args
+    atm=Atmosphere(airmass,pressure,temperature,wlrange)
+    UVspec.clear_run_log()
+    try:
+        result=atm.simulate_sampled(pwv,oz,aer),None
+    except UVspec.UVspecError as error:
+        result=None,str(error)
+    return result,UVspec.run_log()
+
+#----------------------------------------------------------------------------------
+class LinearResampler():
+    """
+    LinearResampler(x,xnew): linear interpolation from the sampling x onto xnew,
+        the same as interp1d(x,y,kind='linear',bounds_error=False,fill_value=0.)(xnew)
+        but the indexes and weights are computed once, for all the y sampled on x
+    Args:
+        x (:obj:`array`): increasing sampling of the data
+        xnew (:obj:`array`): sampling of the result
+    """
+    #---------------------------------------------------------------------------
+    def __init__(self,x,xnew):
+        self.x=np.asarray(x)
+        self.xnew=np.asarray(xnew)
+        # same indexes and operations as interp1d, for identical results
+        self.hi=np.searchsorted(self.x,self.xnew).clip(1,len(self.x)-1)
+        self.lo=self.hi-1
+        self.dx=self.x[self.hi]-self.x[self.lo]
+        self.offset=self.xnew-self.x[self.lo]
+        self.outside=np.logical_or(self.xnew<self.x[0],self.xnew>self.x[-1])
+    #---------------------------------------------------------------------------
+    def __call__(self,y):
+        """
+        Args:
+            y (:obj:`array`): data sampled on x, one row per data set
+        Returns:
+            the data resampled on xnew, with the same number of rows
+        """
+        y=np.asarray(y)
+        y_lo=y[...,self.lo]
+        slope=(y[...,self.hi]-y_lo)/self.dx
+        ynew=slope*self.offset+y_lo
+        ynew[...,self.outside]=0.
+        return ynew
+
+#----------------------------------------------------------------------------------
+def ResampleTransmissions(sampled,wlnew):
+    """
+    ResampleTransmissions(sampled,wlnew): resample the transmissions onto wlnew.
+        The transmissions with the same wavelengths, usually all of them, are
+        resampled at once with one LinearResampler.
+    Args:
+        sampled (:obj:`list`): list of (wl,transmission) arrays, or None
+    Returns:
+        the list of the resampled transmissions, None where sampled is None
+    """
+    resampled=[None]*len(sampled)
+    pending=[index for index,item in enumerate(sampled) if item is not None]
+    while len(pending)>0:
+        wl=sampled[pending[0]][0]
+        same=[index for index in pending if np.array_equal(sampled[index][0],wl)]
+        rows=LinearResampler(wl,wlnew)(np.array([sampled[index][1] for index in same]))
+        for index,row in zip(same,rows):
+            resampled[index]=row
+        same=set(same)
+        pending=[index for index in pending if index not in same]
+    return resampled
         
  
   
@@ -470,6 +1354,27 @@ class TelescopeTransmission():
         
         
                 
+#----------------------------------------------------------------------------------
+def SimulationWavelengthRange(telescope=None,margin=WLMARGIN,threshold=WLTHRESHOLD):
+    """
+    SimulationWavelengthRange(telescope,margin,threshold): the wavelength window libradtran
+        has to simulate : the range of WL, restricted to the wavelengths where the
+        telescope transmits (e.g. above ~700 nm with RG715), plus a margin 
+    Args:
+        telescope (:obj:`TelescopeTransmission`): telescope transmission, None to use WL only
+        margin (:obj:`float`): margin in nm on each side of the window
+        threshold (:obj:`float`): the telescope transmits above threshold times its maximum
+    Returns:
+        the (min,max) wavelengths in nm
+    """
+    wlmin,wlmax=WL[0],WL[-1]
+    if telescope is not None:
+        transmission=telescope.transmission(WL)
+        nonzero=np.where(transmission>threshold*np.max(transmission))[0]
+        if len(nonzero)>0 and np.max(transmission)>0:
+            wlmin,wlmax=WL[nonzero[0]],WL[nonzero[-1]]
+    return (max(float(wlmin)-margin,atmsim.WLMIN_SIM),min(float(wlmax)+margin,atmsim.WLMAX_SIM))
+
 #----------------------------------------------------------------------------------
 class SpectrumSimulation(Spectrum):
     """ 
@@ -546,10 +1451,10 @@ class SpectrumSimGrid():
         self.filename=""
         if filename != "" :
             self.filename = filename
-            self.load_spectrum(filename)
+            self.load_spectra(filename)
 
         if parameters.VERBOSE :
-            print self.header
+            print(self.header)
 
     #----------------------------------------------------------------------------    
     def compute(self):
@@ -561,7 +1466,9 @@ class SpectrumSimGrid():
         self.spectragrid[0,index_atm_data:]=self.lambdas
         self.spectragrid[:,index_atm_count:index_atm_data]=self.atmgrid[:,index_atm_count:index_atm_data] 
         # Is broadcasting working OK ?
-        self.spectragrid[1:,index_atm_data:]=self.atmgrid[1:,index_atm_data:]*all_transm*Factor
+        # the factors are converted first : the product of the grid is done in its type
+        all_transm=np.asarray(all_transm*Factor,dtype=self.spectragrid.dtype)
+        self.spectragrid[1:,index_atm_data:]=self.atmgrid[1:,index_atm_data:]*all_transm
          
         return self.spectragrid
     #---------------------------------------------------------------------------
@@ -598,8 +1505,30 @@ class SpectrumSimGrid():
          
             hdu = fits.PrimaryHDU(self.spectragrid,header=self.header)
             hdu.writeto(self.filename,overwrite=True)
+            if FLAG_NPY_SIDECAR:
+                WriteSidecar(self.filename,self.spectragrid)
             if parameters.VERBOSE or parameters.DEBUG:
                 self.my_logger.info('\n\tSPECTRA.save atm-file=%s' % (self.filename))
+    #---------------------------------------------------------------------------  
+    def load_spectra(self,filename,mmap=False):
+        """
+        load_spectra(filename,mmap): loads a spectrasim file written by save_spectra
+        Args:
+            filename (:obj:`str`): the spectrasim file
+            mmap (:obj:`bool`): if True spectragrid is a read-only memory map of the file
+                (or of its .npy sidecar, see OpenGridFile), otherwise it is of type GRID_DTYPE
+        Returns:
+            the spectra grid
+        """
+        self.filename = filename
+        data,self.header=OpenGridFile(filename,mmap)
+        if mmap:
+            self.spectragrid=data
+        else:
+            self.spectragrid=np.array(data,dtype=GRID_DTYPE)
+        if parameters.VERBOSE or parameters.DEBUG:
+            self.my_logger.info('\n\tSPECTRA.load file=%s' % (self.filename))
+        return self.spectragrid
     #---------------------------------------------------------------------------            
    
 #----------------------------------------------------------------------------------        
@@ -650,7 +1579,7 @@ def SpectractorInit(filename,outputdir):
     
        
 #----------------------------------------------------------------------------------
-def SpectractorSimGrid(filename,outputdir):
+def SpectractorSimGrid(filename,outputdir,atmfilename=None):
     
     """ SpectractorSimGrid
     Main function to simulate several spectra 
@@ -659,6 +1588,9 @@ def SpectractorSimGrid(filename,outputdir):
     Args:
         filename (:obj:`str`): filename of the image (data)
         outputdir (:obj:`str`): path to the output directory
+        atmfilename (:obj:`str`): atmospheric grid shared with other exposures
+            (see SpectractorSimNight), linked as the atmsim file of this exposure
+            instead of being computed
         
     """
     my_logger = parameters.set_logger(__name__)
@@ -677,18 +1609,16 @@ def SpectractorSimGrid(filename,outputdir):
     airmass = spectrum.header['AIRMASS']
     pressure = spectrum.header['OUTPRESS']
     temperature = spectrum.header['OUTTEMP']
-    atm = AtmosphereGrid(airmass,pressure,temperature,filename)
-    
-    # test if file already exists
-    #if os.path.exists(output_atmfilename) and os.path.getsize(output_atmfilename)>MINFILESIZE:       
-    #    filesize= os.path.getsize(output_atmfilename)
-    #    infostring=" atmospheric simulation file %s of size %d already exists, thus load it ..." % (output_atmfilename,filesize)
-    #    my_logger.info(infostring)
-    #    atmgrid,header=atm.loadfile(output_atmfilename)
-    #else:
-    atmgrid = atm.compute()
-    header = atm.savefile(filename=output_atmfilename)
-    atmsim.CleanSimDir()    
+    wlrange = None
+    if FLAG_TRIM_WAVELENGTH:
+        wlrange = SimulationWavelengthRange(telescope)
+    atm = AtmosphereGrid(airmass,pressure,temperature,filename,wlrange)
+    
+    if atmfilename is not None:
+        atmgrid,header = atm.loadfile(atmfilename)
+        LinkFile(atmfilename,output_atmfilename)
+    else:
+        atmgrid,header = SimulateAtmosphereGrid(atm,output_atmfilename)
     if parameters.VERBOSE:
         infostring='\n\t ========= Atmospheric simulation :  ==============='
         my_logger.info(infostring)
@@ -706,6 +1636,157 @@ def SpectractorSimGrid(filename,outputdir):
         spectra.plot_spectra()
         spectra.plot_spectra_img()
     #--------------------------------------------------------------------------- 
+
+
+#----------------------------------------------------------------------------------
+def SimulateAtmosphereGrid(atm,output_atmfilename):
+    """ SimulateAtmosphereGrid
+    compute the atmospheric grid and save it, or load it from output_atmfilename
+    when this file holds the same grid (see AtmosphereGrid.compare_file)
+    
+    Args:
+        atm (:obj:`AtmosphereGrid`): the grid to compute
+        output_atmfilename (:obj:`str`): the atmsim file
+    Returns:
+        the atmospheric grid and the header of the atmsim file
+    """
+    my_logger = parameters.set_logger(__name__)
+    # reuse the file of a previous run if it holds the same grid
+    if FLAG_REUSE_GRIDS and os.path.exists(output_atmfilename):
+        differences=atm.compare_file(output_atmfilename)
+        if len(differences)==0:
+            my_logger.info('\n\tatmospheric simulation file %s already exists, thus load it' % output_atmfilename)
+            return atm.loadfile(output_atmfilename)
+        my_logger.info('\n\tatmospheric simulation file %s is recomputed : %s' % (output_atmfilename,', '.join(differences)))
+    checkpoint=None
+    if FLAG_CHECKPOINT:
+        checkpoint=output_atmfilename+CHECKPOINT_SUFFIX
+    atmgrid = atm.compute(checkpoint=checkpoint)
+    header = atm.savefile(filename=output_atmfilename)
+    # kept while points are missing : the next run only simulates them
+    if checkpoint is not None and len(atm.failed_points)==0 and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    atmsim.ClearOpticalDepths()
+    atmsim.CleanSimDir()    
+    return atmgrid,header
+
+
+#----------------------------------------------------------------------------------
+def LinkFile(source,destination):
+    """ LinkFile
+    make destination a relative symbolic link to source, a copy where
+    symbolic links are not available. An existing destination is replaced.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.symlink(os.path.relpath(source,os.path.dirname(os.path.abspath(destination))),destination)
+    except (AttributeError,NotImplementedError,OSError):
+        shutil.copyfile(source,destination)
+
+
+#----------------------------------------------------------------------------------
+def SnapToLattice(value,step):
+    """ SnapToLattice
+    the node of the lattice of spacing step closest to value
+    """
+    return np.round(np.asarray(value)/step)*step
+
+
+#----------------------------------------------------------------------------------
+def PlanNightGrids(filenames,airmass_step=None,pressure_step=None):
+    """ PlanNightGrids
+    Group the exposures of a night by their (airmass,pressure) rounded to a lattice :
+    the exposures of a group share one atmospheric grid, computed at the lattice node.
+
+    Args:
+        filenames (:obj:`list`): spectrum files of the night
+        airmass_step (:obj:`float`): airmass step of the lattice, default AIRMASS_STEP
+        pressure_step (:obj:`float`): pressure step in hPa of the lattice, default PRESSURE_STEP
+    Returns:
+        pandas DataFrame, one row per exposure : file, airmass, pressure, temperature,
+        the lattice node airmass_grid, pressure_grid and the atmsim file grid of the group
+    """
+    if airmass_step is None:
+        airmass_step=AIRMASS_STEP
+    if pressure_step is None:
+        pressure_step=PRESSURE_STEP
+    rows=[]
+    for filename in filenames:
+        header=fits.getheader(filename)
+        rows.append((filename,header['AIRMASS'],header['OUTPRESS'],header['OUTTEMP']))
+    plan=pd.DataFrame(rows,columns=['file','airmass','pressure','temperature'])
+    plan['airmass_grid']=SnapToLattice(plan['airmass'].values,airmass_step)
+    plan['pressure_grid']=SnapToLattice(plan['pressure'].values,pressure_step)
+    plan['grid']=['atmsim_z%.3f_p%.1f.fits' % (z,p) for z,p in zip(plan['airmass_grid'],plan['pressure_grid'])]
+    return plan
+
+
+#----------------------------------------------------------------------------------
+def EstimateNightGridError(plan,atmosphere=None):
+    """ EstimateNightGridError
+    Maximum difference of transmission introduced by the lattice of PlanNightGrids :
+    the reference atmosphere is simulated at the (airmass,pressure) of the exposures
+    the farthest from their node, in airmass and in pressure, and at their node.
+
+    Args:
+        plan (:obj:`DataFrame`): the plan of PlanNightGrids
+        atmosphere (:obj:`tuple`): (pwv,ozone,aerosols), default NIGHT_REFERENCE_ATMOSPHERE
+    Returns:
+        the maximum absolute difference of transmission over WL
+    """
+    if atmosphere is None:
+        atmosphere=NIGHT_REFERENCE_ATMOSPHERE
+    pwv,ozone,aerosols=atmosphere
+    worst=set([np.argmax(np.abs(plan['airmass']-plan['airmass_grid']).values),
+               np.argmax(np.abs(plan['pressure']-plan['pressure_grid']).values)])
+    error=0.
+    for index in worst:
+        row=plan.iloc[index]
+        exact=Atmosphere(row['airmass'],row['pressure'],row['temperature']).simulate(pwv,ozone,aerosols)(WL)
+        node=Atmosphere(row['airmass_grid'],row['pressure_grid'],row['temperature']).simulate(pwv,ozone,aerosols)(WL)
+        error=max(error,np.max(np.abs(exact-node)))
+    return error
+
+
+#----------------------------------------------------------------------------------
+def SpectractorSimNight(filenames,outputdir,airmass_step=None,pressure_step=None,estimate_error=True):
+    """ SpectractorSimNight
+    SpectractorSimGrid for all the exposures of a night, the exposures with close
+    airmasses and pressures share one atmospheric grid (see PlanNightGrids).
+    The grids are written in outputdir/atmgrids and the atmsim file of each
+    exposure is a link to its grid. The plan is written in atmgrids/night_plan.csv.
+
+    Args:
+        filenames (:obj:`list`): spectrum files of the night
+        outputdir (:obj:`str`): path to the output directory
+        airmass_step (:obj:`float`): airmass step of the lattice, default AIRMASS_STEP
+        pressure_step (:obj:`float`): pressure step in hPa of the lattice, default PRESSURE_STEP
+        estimate_error (:obj:`bool`): estimate the error of the lattice, see EstimateNightGridError
+    Returns:
+        the plan, pandas DataFrame
+    """
+    my_logger = parameters.set_logger(__name__)
+    griddir=os.path.join(outputdir,NIGHT_GRIDDIR)
+    ensure_dir(griddir)
+    plan=PlanNightGrids(filenames,airmass_step,pressure_step)
+    groups=plan.groupby('grid',sort=False)
+    my_logger.info('\n\tSpectractorSimNight : %d exposures, %d atmospheric grids' % (len(plan),len(groups)))
+    if estimate_error:
+        error=EstimateNightGridError(plan)
+        my_logger.info('\n\tSpectractorSimNight : maximum transmission error of the lattice %.2e' % error)
+    
+    for grid,group in groups:
+        atmfilename=os.path.join(griddir,grid)
+        # not trimmed in wavelength : the grid may serve exposures with different filters
+        atm=AtmosphereGrid(group['airmass_grid'].iloc[0],group['pressure_grid'].iloc[0],
+                           group['temperature'].mean(),group['file'].iloc[0])
+        SimulateAtmosphereGrid(atm,atmfilename)
+        for filename in group['file']:
+            SpectractorSimGrid(filename,outputdir,atmfilename=atmfilename)
+    
+    plan.to_csv(os.path.join(griddir,NIGHT_PLAN),index=False)
+    return plan
     
        
 #----------------------------------------------------------------------------------
@@ -736,7 +1817,13 @@ def SpectractorSim(filename,outputdir,lambdas,pwv=5,ozone=300,aerosols=0.05,over
     temperature = spectrum.header['OUTTEMP']
     if pressure <700:  # sometimes the weather data are bad so force a reasonable pressure
         temperature = 10.0  # Celcius degrees
-    atmosphere = Atmosphere(airmass,pressure,temperature)
+    if TRANSMISSION_TABLE is not None:
+        atmosphere = TableAtmosphere(airmass,pressure,temperature)
+    else:
+        wlrange = None
+        if FLAG_TRIM_WAVELENGTH:
+            wlrange = SimulationWavelengthRange(telescope)
+        atmosphere = Atmosphere(airmass,pressure,temperature,wlrange)
     atmosphere.simulate(pwv,ozone,aerosols)  
     
     if parameters.VERBOSE: